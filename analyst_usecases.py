@@ -1,39 +1,60 @@
 from models.analyst import Analyst
-from config import BASE_URL_QUERY_HYPNO, BASE_URL_QUERY_DNA
+from config import BASE_URL_QUERY_HYPNO, BASE_URL_QUERY_DNA, BASE_URL_QUERY_MANY, BASE_URL_AGGREGATE, BASE_URL_QUERY_VALUES
 
 def hypnogram_case():
     analyst = Analyst("Seppo")
     hypno_query_value = 7
     user_id_query = 1
-    hypno_response = analyst.query_data(user_id_query, hypno_query_value, BASE_URL_QUERY_HYPNO)
+    # The server computes the statistics, the decrypted vector isn't sent
+    hypno_stats = analyst.query_data(user_id_query, hypno_query_value, BASE_URL_QUERY_HYPNO, aggregation="all")
 
-    hypno_count = analyst.count_the_value(hypno_response)
-    print(f"Count for value {hypno_query_value}: {hypno_count}")
-
-    hypno_transitions = analyst.count_transitions(hypno_response)
-    print(f"Amount of transitions for value {hypno_query_value}: {hypno_transitions}")
-
-    hypno_sequense = analyst.count_sequences(hypno_response)
-    print(f"Amount of sequences for value {hypno_query_value}: {hypno_sequense}")
+    print(f"Count for value {hypno_query_value}: {hypno_stats['count']}")
+    print(f"Amount of transitions for value {hypno_query_value}: {hypno_stats['transitions']}")
+    print(f"Amount of sequences for value {hypno_query_value}: {hypno_stats['sequences']}")
 
 def dna_case():
     analyst = Analyst("Harri")
     dna_query_value = "AG"
     user_id_query = 13
-    dna_response = analyst.query_data(user_id_query, dna_query_value, BASE_URL_QUERY_DNA)
+    # The server computes the statistics, the decrypted vector isn't sent
+    dna_stats = analyst.query_data(user_id_query, dna_query_value, BASE_URL_QUERY_DNA, aggregation="all")
+
+    print(f"Count for value {dna_query_value}: {dna_stats['count']}")
+    print(f"Amount of transitions for value {dna_query_value}: {dna_stats['transitions']}")
+    print(f"Amount of sequences for value {dna_query_value}: {dna_stats['sequences']}")
 
-    dna_count = analyst.count_the_value(dna_response)
-    print(f"Count for value {dna_query_value}: {dna_count}")
+def stages_case():
+    analyst = Analyst("Seppo")
+    user_id_query = 1
+    # Every sleep stage with one request instead of one query per stage
+    stages = analyst.query_values(user_id_query, "all", BASE_URL_QUERY_VALUES)
+
+    print(f"Stage histogram: {stages['histogram']}")
+    print(f"Stage transitions (rows: from, columns: to, stages {stages['values']}):")
+    for value, row in zip(stages['values'], stages['transition_matrix']):
+        print(f"{value:>3}: {row}")
+
+def population_case():
+    analyst = Analyst("Seppo")
+    hypno_query_value = 7
+    # All users from 0 to 99 with one request
+    responses = analyst.query_many(None, hypno_query_value, BASE_URL_QUERY_MANY, first_id=0, last_id=99, aggregation="count")
 
-    dna_transitions = analyst.count_transitions(dna_response)
-    print(f"Amount of transitions for value {dna_query_value}: {dna_transitions}")
+    counts = [response['count'] for response in responses.values()]
+    print(f"Users with value {hypno_query_value}: {sum(count > 0 for count in counts)} of {len(counts)}")
+    print(f"Total count for value {hypno_query_value}: {sum(counts)}")
 
-    dna_sequense = analyst.count_sequences(dna_response)
-    print(f"Amount of sequences for value {dna_query_value}: {dna_sequense}")
+    # The same counts computed on the server, only the aggregates are sent back
+    aggregates = analyst.aggregate(hypno_query_value, BASE_URL_AGGREGATE, first_id=0, last_id=99)
+    print(f"Total count for value {hypno_query_value} (server): {aggregates['total_count']}")
+    print(f"Users per count of value {hypno_query_value}: {aggregates['histogram']}")
+    print(f"Mean run length of value {hypno_query_value}: {aggregates['mean_run_length']:.2f}")
 
 def inser_data():
     data = {}
 
 if __name__ == '__main__':
     hypnogram_case()
-    dna_case()
\ No newline at end of file
+    dna_case()
+    stages_case()
+    population_case()
\ No newline at end of file
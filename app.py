@@ -1,14 +1,16 @@
 from flask import Flask, request, jsonify
 import atexit
-from models.handlers import DBHandler
-from models.user import User, create_user
+from models.handlers import DBHandler, close_pooled_connections
+from models.user import create_user, create_users
 from models.curator import Curator
-from spade import SPADE
-from config import DbName, TbName, MODULUS, GENERATOR, MAX_PT_VEC_SIZE
+from models.query import query_user, query_user_values, query_users, aggregate_users
+import functools
+import stats
+import result_codec
+from config import DbName, TbName, MAX_PT_VEC_SIZE, HYPNO_VALUES, DNA_VALUES, KEYSTORE_FILE
 from utils import map_dinucleotide_to_int
 import os
 import time
-import tracemalloc
 
 app = Flask(__name__)
 
@@ -83,6 +85,32 @@ def register_dna():
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/register/bulk', methods=['POST'])
+def register_bulk():
+    start_time = time.time()
+    try:
+        # Get the users from request: {"users": [{"user_id": ..., "data": [...]}, ...]}
+        data = request.get_json()
+        users = [(user['user_id'], user['data']) for user in data['users']]
+
+        # Encrypt the users in parallel and insert them in one transaction
+        statuses, time_of_enc, time_of_insert = create_users(users, MAX_PT_VEC_SIZE, curator)
+
+        elapsed_time = time.time() - start_time
+        registered = sum(status['status'] == "success" for status in statuses)
+        print(f"{registered}/{len(users)} users finished in {elapsed_time:.10f} seconds")
+
+        return jsonify({
+            "status": "success",
+            "message": f"{registered} of {len(users)} users registered",
+            "results": statuses,
+            "time_of_enc": time_of_enc,
+            "time_of_insert": time_of_insert
+        }), 200
+
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
 
 @app.route('/analyst/query_hypno', methods=['POST'])
 def analyst_query():
@@ -92,44 +120,39 @@ def analyst_query():
         data = request.get_json()
         user_id = data['user_id']
         query_value = data['query_value']
+        aggregation = data.get('aggregation')  # Optional: "count", "transitions", "sequences" or "all"
+        if aggregation:
+            stats.check_aggregation(aggregation)
+        encoding = data.get('encoding')  # Optional: "bitmap", "positions", "runs" or "list"
+        if encoding:
+            result_codec.check_encoding(encoding)
 
         db_handler2 = DBHandler(DbName, TbName)
 
         # Retrieve user data from the database
-        user_req = db_handler2.get_user_req_by_id(user_id)
+        start_time = time.time()
+        user_req = db_handler2.get_user_req_by_id(user_id, as_vector=True)
+        time_of_read = time.time() - start_time
         if not user_req:
             return jsonify({"status": "error", "message": "User data not found!"}), 404
 
         db_handler2.close_connection()
 
-        # Start the analyst operation (decrypt the user's data)
-        spade = SPADE(MODULUS, GENERATOR, MAX_PT_VEC_SIZE)
-        
-
-        # Derive decryption keys using the provided query value and the registration key
-        reg_key = int.from_bytes(user_req['reg_key'], byteorder='big')
-        tracemalloc.start()
-        start_time = time.time()
-        dk = spade.key_derivation(user_id, query_value, curator.sks, reg_key)
-        time_of_kd = time.time() - start_time
-        current_kd, peak_memory_kd = tracemalloc.get_traced_memory()
-        tracemalloc.stop()
-
-        # Decrypt the ciphertext using the derived keys
-        ciphertext = user_req['ciphertext']
-        # Reconstruct ciphertext from stored bytes
-        reconstructed_ciphertext = []
-        for c0_bytes, c1_bytes in ciphertext:  # Assume storage preserves tuple structure
-            c0 = int.from_bytes(c0_bytes, byteorder='big')
-            c1 = int.from_bytes(c1_bytes, byteorder='big')
-            reconstructed_ciphertext.append([c0, c1])  # Restore as [c0, c1] pairs
-
-        tracemalloc.start()
+        # Derive the decryption keys and decrypt the user's data, in a worker process when
+        # the server runs with a worker pool (see serve.py)
+        # The statistics and the compact encodings only need to know which positions match
+        matches = bool(aggregation) or encoding not in (None, "list")
         start_time = time.time()
-        decrypted = spade.decrypt(dk, query_value, reconstructed_ciphertext)
-        time_of_decrypt = time.time() - start_time
-        current_dec, peak_memory_dec = tracemalloc.get_traced_memory()
-        tracemalloc.stop()
+        decrypted, measures = query_user(curator, user_req, query_value, matches)
+
+        # With an aggregation only the statistics are sent back, computed in one pass over the result
+        if aggregation:
+            result = {"aggregates": stats.aggregate(decrypted, aggregation)}
+        elif encoding:
+            # Compact encoding of the matching positions, see result_codec
+            result = {"encoded_result": result_codec.encode_result(decrypted, encoding)}
+        else:
+            result = {"decrypted_result": decrypted}
 
         # Time taken
         elapsed_time = time.time() - start_time
@@ -139,13 +162,9 @@ def analyst_query():
         return jsonify({
             "status": "success",
             "query_value": query_value,
-            "decrypted_result": decrypted,  # Return the decrypted result
-            "time_of_kd": time_of_kd,
-            "time_of_dec": time_of_decrypt,
-            "current_kd": current_kd,
-            "peak_memory_kd": peak_memory_kd,
-            "current_dec": current_dec,
-            "peak_memory_dec": peak_memory_dec
+            **result,  # The decrypted result, or only its statistics with an aggregation
+            "time_of_read": time_of_read,
+            **measures  # The time and the memory of the key derivation, the decoding and the decryption
         }), 200
 
     except Exception as e:
@@ -159,6 +178,12 @@ def analyst_query_dna():
         data = request.get_json()
         user_id = data['user_id']
         query_value_str = data['query_value']  # This will be a string like "CC"
+        aggregation = data.get('aggregation')  # Optional: "count", "transitions", "sequences" or "all"
+        if aggregation:
+            stats.check_aggregation(aggregation)
+        encoding = data.get('encoding')  # Optional: "bitmap", "positions", "runs" or "list"
+        if encoding:
+            result_codec.check_encoding(encoding)
 
         # Map dinucleotide to integer (e.g., "CC" -> 6)
         query_value = map_dinucleotide_to_int([query_value_str])[0]
@@ -166,39 +191,29 @@ def analyst_query_dna():
         db_handler2 = DBHandler(DbName, TbName)
 
         # Retrieve user data from the database
-        user_req = db_handler2.get_user_req_by_id(user_id)
+        start_time = time.time()
+        user_req = db_handler2.get_user_req_by_id(user_id, as_vector=True)
+        time_of_read = time.time() - start_time
         if not user_req:
             return jsonify({"status": "error", "message": "User data not found!"}), 404
 
         db_handler2.close_connection()
 
-        # Start the analyst operation (decrypt the user's data)
-        spade = SPADE(MODULUS, GENERATOR, MAX_PT_VEC_SIZE)
-        
-        tracemalloc.start()
-        start_time = time.time()
-        # Derive decryption keys using the provided query value and the registration key
-        reg_key = int.from_bytes(user_req['reg_key'], byteorder='big')
-        dk = spade.key_derivation(user_id, query_value, curator.sks, reg_key)
-        time_of_kd = time.time() - start_time
-        current_kd, peak_memory_kd = tracemalloc.get_traced_memory()
-        tracemalloc.stop()
-
-        # Reconstruct ciphertext from stored bytes
-        ciphertext = user_req['ciphertext']        
-        reconstructed_ciphertext = []
-        for c0_bytes, c1_bytes in ciphertext:  # Assume storage preserves tuple structure
-            c0 = int.from_bytes(c0_bytes, byteorder='big')
-            c1 = int.from_bytes(c1_bytes, byteorder='big')
-            reconstructed_ciphertext.append([c0, c1])  # Restore as [c0, c1] pairs
-
-        # Decrypt the ciphertext using the derived keys
-        tracemalloc.start()
+        # Derive the decryption keys and decrypt the user's data, in a worker process when
+        # the server runs with a worker pool (see serve.py)
+        # The statistics and the compact encodings only need to know which positions match
+        matches = bool(aggregation) or encoding not in (None, "list")
         start_time = time.time()
-        decrypted = spade.decrypt(dk, query_value, reconstructed_ciphertext)
-        time_of_decrypt = time.time() - start_time
-        current_dec, peak_memory_dec = tracemalloc.get_traced_memory()
-        tracemalloc.stop()
+        decrypted, measures = query_user(curator, user_req, query_value, matches)
+
+        # With an aggregation only the statistics are sent back, computed in one pass over the result
+        if aggregation:
+            result = {"aggregates": stats.aggregate(decrypted, aggregation)}
+        elif encoding:
+            # Compact encoding of the matching positions, see result_codec
+            result = {"encoded_result": result_codec.encode_result(decrypted, encoding)}
+        else:
+            result = {"decrypted_result": decrypted}
 
         # Time taken
         elapsed_time = time.time() - start_time
@@ -208,29 +223,174 @@ def analyst_query_dna():
         return jsonify({
             "status": "success",
             "query_value": query_value,
-            "decrypted_result": decrypted,
-            "time_of_kd": time_of_kd,
-            "time_of_dec": time_of_decrypt,
-            "current_kd": current_kd,
-            "peak_memory_kd": peak_memory_kd,
-            "current_dec": current_dec,
-            "peak_memory_dec": peak_memory_dec
+            **result,  # The decrypted result, or only its statistics with an aggregation
+            "time_of_read": time_of_read,
+            **measures  # The time and the memory of the key derivation, the decoding and the decryption
+        }), 200
+
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/analyst/query_many', methods=['POST'])
+def analyst_query_many():
+    start_time = time.time()
+    try:
+        # Get analyst data from request: "user_ids" (a list) or "first_id" and "last_id" (a range), and "query_value"
+        data = request.get_json()
+        user_ids = data.get('user_ids')
+        query_value = data['query_value']
+        aggregation = data.get('aggregation')  # Optional, like in the single user queries
+        encoding = data.get('encoding')  # Optional, like in the single user queries
+        if isinstance(query_value, str):
+            # DNA query, map the dinucleotide to integer (e.g., "CC" -> 6)
+            query_value = map_dinucleotide_to_int([query_value])[0]
+
+        # Stream the users' rows from one batched SELECT and decrypt them in parallel
+        db_handler2 = DBHandler(DbName, TbName)
+        user_reqs = db_handler2.iter_user_reqs(user_ids, data.get('first_id'), data.get('last_id'))
+        results = []
+        # With an aggregation (or an encoding) the workers send back only the statistics (or the encoded result) of each user
+        if aggregation:
+            stats.check_aggregation(aggregation)
+            mapper, key = functools.partial(stats.aggregate, aggregation=aggregation), "aggregates"
+        elif encoding:
+            result_codec.check_encoding(encoding)
+            mapper, key = functools.partial(result_codec.encode_result, encoding=encoding), "encoded_result"
+        else:
+            mapper, key = None, "decrypted_result"
+        matches = bool(aggregation) or encoding not in (None, "list")
+        for user_id, result, error in query_users(curator, user_reqs, query_value, mapper=mapper, matches=matches):
+            if error is None:
+                results.append({"user_id": user_id, "status": "success", key: result})
+            else:
+                results.append({"user_id": user_id, "status": "error", "message": error})
+        db_handler2.close_connection()
+
+        if user_ids is not None:
+            found = {result['user_id'] for result in results}
+            results.extend({"user_id": user_id, "status": "error", "message": "User data not found!"}
+                           for user_id in dict.fromkeys(user_ids) if user_id not in found)
+
+        # Time taken
+        elapsed_time = time.time() - start_time
+        print(f"Query of {len(results)} users finished in {elapsed_time:.10f} seconds")
+
+        return jsonify({
+            "status": "success",
+            "query_value": query_value,
+            "results": results,
+            "time_of_query": elapsed_time
         }), 200
 
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+
+@app.route('/analyst/query_values', methods=['POST'])
+def analyst_query_values():
+    start_time = time.time()
+    try:
+        # Get analyst data from request: "user_id", "values" (a list, or "all" values of the "domain": "hypnogram" or "dna")
+        data = request.get_json()
+        user_id = data['user_id']
+        values = data['values']
+        domain = data.get('domain', "hypnogram")
+        if values == "all":
+            values = DNA_VALUES if domain == "dna" else HYPNO_VALUES
+        # DNA values can be given as dinucleotides (e.g., "CC" -> 6)
+        values = [map_dinucleotide_to_int([value])[0] if isinstance(value, str) else value for value in values]
+
+        db_handler2 = DBHandler(DbName, TbName)
+
+        # Retrieve user data from the database
+        user_req = db_handler2.get_user_req_by_id(user_id, as_vector=True)
+        if not user_req:
+            return jsonify({"status": "error", "message": "User data not found!"}), 404
+
+        db_handler2.close_connection()
+
+        # Decrypt the ciphertext for all values at once, it is decoded only once
+        start_time = time.time()
+        matches_by_value = query_user_values(curator, user_req, values)
+        time_of_dec = time.time() - start_time
+
+        # The histogram and the transition matrix of the values
+        result = stats.histogram_and_transitions(matches_by_value)
+
+        # Time taken
+        elapsed_time = time.time() - start_time
+        print(f"Query of {len(values)} values finished in {elapsed_time:.10f} seconds")
+
+        return jsonify({
+            "status": "success",
+            **result,
+            "time_of_dec": time_of_dec
+        }), 200
+
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/analyst/aggregate', methods=['POST'])
+def analyst_aggregate():
+    start_time = time.time()
+    try:
+        # Get analyst data from request: "user_ids" (a list) or "first_id" and "last_id" (a range, all users if none), and "query_value"
+        data = request.get_json()
+        user_ids, first_id, last_id = data.get('user_ids'), data.get('first_id'), data.get('last_id')
+        query_value = data['query_value']
+        if isinstance(query_value, str):
+            # DNA query, map the dinucleotide to integer (e.g., "CC" -> 6)
+            query_value = map_dinucleotide_to_int([query_value])[0]
+
+        # Count the value of every user in the workers and reduce the counts here
+        db_handler2 = DBHandler(DbName, TbName)
+        user_reqs = db_handler2.iter_user_reqs(user_ids, first_id, last_id)
+        aggregates = aggregate_users(curator, user_reqs, query_value)
+        db_handler2.close_connection()
+
+        # Time taken
+        elapsed_time = time.time() - start_time
+        print(f"Aggregate of {aggregates['users']} users finished in {elapsed_time:.10f} seconds")
+
+        return jsonify({
+            "status": "success",
+            "query_value": query_value,
+            **aggregates,
+            "time_of_query": elapsed_time
+        }), 200
+
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
 def cleanup():
-    """Close the database connection and remove the database file when the program exits."""
+    """Close the database connection and remove the database file when the program exits (keep it with a keystore)."""
     try:
+        # Stop the background randomness workers
+        if curator.randomness_pool is not None:
+            curator.randomness_pool.stop()
+        # Stop the server's worker processes and remove the shared memory of the keys they used
+        curator.stop_worker_pool()
+        curator.close_shared_keys(keep_kd_bases=False)
+
         # Ensure the database connection is closed
         db_handler.close_connection()  # Ensure DBHandler has a close_connection() method
+        close_pooled_connections()
         print("Database connection closed.")
 
-        # Remove the database file
+        if KEYSTORE_FILE:
+            # The key derivation bases are added to the keystore at registration (see Curator.store_kd_bases),
+            # nothing is saved here: with debug=True the reloader's parent process runs this too
+            print(f"Keystore {KEYSTORE_FILE} and database {DbName} are kept.")
+            return
+
+        # Remove the database file (and the WAL files next to it)
         if os.path.exists(DbName):
             os.remove(DbName)
             print(f"Database {DbName} has been removed.")
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(DbName + suffix):
+                os.remove(DbName + suffix)
     except Exception as e:
         print(f"Error during cleanup: {e}")
 
@@ -0,0 +1,62 @@
+# backend.py
+import config
+
+class PythonBackend:
+    """
+    Big-integer arithmetic with Python's built-in int and pow.
+    """
+    name = "python"
+
+    def mpz(self, x):
+        return x
+
+    def to_ints(self, values):
+        return values
+
+    def powmod(self, base, exponent, modulus):
+        return pow(base, exponent, modulus)
+
+    def invert(self, x, modulus):
+        return pow(x, -1, modulus)
+
+
+class GmpBackend:
+    """
+    Big-integer arithmetic with GMP through gmpy2 (raises ImportError if gmpy2 is not installed).
+    Values stay gmpy2.mpz inside SPADE and are converted back to int when returned.
+    """
+    name = "gmpy2"
+
+    def __init__(self):
+        import gmpy2
+        self.mpz = gmpy2.mpz
+        self.powmod = gmpy2.powmod
+        self.invert = gmpy2.invert
+
+    def to_ints(self, values):
+        return [int(x) for x in values]
+
+
+BACKENDS = {
+    "python": PythonBackend,
+    "gmpy2": GmpBackend,
+}
+
+def get_backend(name=None):
+    """
+    Return the arithmetic backend `name` ("python", "gmpy2" or "auto", default config.ARITH_BACKEND).
+    "auto" picks gmpy2 when it is installed and falls back to Python ints otherwise.
+    A backend instance is returned as is.
+    """
+    if name is None:
+        name = config.ARITH_BACKEND
+    if not isinstance(name, str):
+        return name
+    if name == "auto":
+        try:
+            return GmpBackend()
+        except ImportError:
+            return PythonBackend()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown arithmetic backend: {name}")
+    return BACKENDS[name]()
@@ -0,0 +1,538 @@
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import tracemalloc
+import time
+import config
+from spade import SPADE
+from fixed_base import FixedBaseTable
+from backend import BACKENDS
+from models.randomness_pool import RandomnessPool
+from models.curator import Curator
+from models.user import create_user, create_users
+from models.query import decrypt_user, query_users, aggregate_users
+from result_codec import ENCODINGS, encode_result
+from models.handlers import DBHandler, close_pooled_connections
+from ciphertext import CiphertextVector
+from config import MODULUS, GENERATOR
+from utils import random_element_in_zmod, random_elements_in_zmod
+
+# Benchmarks for the SPADE hot paths, run without the server:
+#   python benchmark.py              (all benchmarks)
+#   python benchmark.py decrypt      (only the named one)
+
+def timed(func, *args, repeat=3):
+    """Return the best wall-clock time of `repeat` calls and the result of the last call."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start_time = time.time()
+        result = func(*args)
+        elapsed_time = time.time() - start_time
+        best = elapsed_time if best is None else min(best, elapsed_time)
+    return best, result
+
+def random_residues(n, q=MODULUS):
+    return [random.randint(1, q - 1) for _ in range(n)]
+
+def odd_residues(n, q=MODULUS):
+    """Encryption randomness r_i (made odd like SPADE does) that can be shared between implementations."""
+    return [r + 1 if r % 2 == 0 else r for r in random_residues(n, q)]
+
+def bench_decrypt(sizes=(1000, 100000)):
+    """Compare the per-element decrypt loop with the batch-inversion decrypt."""
+    print("=== decrypt vs decrypt_batch")
+    value = 7
+    for n in sizes:
+        spade = SPADE(MODULUS, GENERATOR, n)
+        dk = random_residues(n)
+        ciphertexts = [[c0, c1] for c0, c1 in zip(random_residues(n), random_residues(n))]
+
+        time_loop, res_loop = timed(spade.decrypt, dk, value, ciphertexts)
+        time_batch, res_batch = timed(spade.decrypt_batch, dk, value, ciphertexts)
+        assert res_loop == res_batch, "decrypt_batch result differs from decrypt"
+        print(f"n={n:>7} | decrypt: {time_loop:.4f}s | decrypt_batch: {time_batch:.4f}s | speedup: {time_loop / time_batch:.2f}x")
+
+def legacy_encrypt(spade, pks, alpha, data, rs):
+    """The original SPADE.encrypt loop (three full exponentiations per element), kept as the baseline."""
+    q, g = spade.q, spade.g
+    ciphertext = []
+    for i in range(spade.n):
+        r = rs[i]
+        c0 = pow(g, r + alpha, q)
+        c1 = (pow(pks[i], alpha, q) * pow(pow(g, r, q), data[i], q)) % q
+        ciphertext.append([c0, c1])
+    return ciphertext
+
+def bench_encrypt(sizes=(1000,)):
+    """Compare the original encrypt loop with SPADE.encrypt with the same keys and randomness."""
+    print("=== legacy encrypt vs encrypt")
+    for n in sizes:
+        spade = SPADE(MODULUS, GENERATOR, n)
+        sks, pks, _, _ = spade.setup()
+        alpha = random.randint(1, MODULUS - 1)
+        data = [random.randint(1, 16) for _ in range(n)]
+
+        rs = odd_residues(n)
+        time_legacy, ct_legacy = timed(legacy_encrypt, spade, pks, alpha, data, rs, repeat=1)
+        time_new, ct_new = timed(lambda: spade.encrypt(pks, alpha, data, randomness=[spade.g_table.pow(r) for r in rs]), repeat=1)
+        assert ct_legacy == ct_new, "encrypt output differs from the original encrypt"
+        print(f"n={n:>7} | legacy: {time_legacy:.4f}s ({n / time_legacy:.0f} el/s) | encrypt: {time_new:.4f}s ({n / time_new:.0f} el/s) | speedup: {time_legacy / time_new:.2f}x")
+
+def bench_setup(sizes=(1000, 100000)):
+    """Compare g^sk with the built-in pow against the fixed-base g table of SPADE.setup."""
+    print("=== setup: pow(g, sk, q) vs g table")
+    for n in sizes:
+        spade = SPADE(MODULUS, GENERATOR, n)
+        sks = random_residues(n)
+        time_pow, pks_pow = timed(lambda: [pow(GENERATOR, sk, MODULUS) for sk in sks], repeat=1)
+        time_table, pks_table = timed(lambda: [spade.g_table.pow(sk) for sk in sks], repeat=1)
+        assert pks_pow == pks_table, "g table result differs from pow"
+        print(f"n={n:>7} | pow: {time_pow:.4f}s | g table: {time_table:.4f}s | speedup: {time_pow / time_table:.2f}x")
+
+def bench_pk_tables(n=1000, windows=(0, 4, 6, 8), users=5):
+    """Encrypt throughput with per-public-key fixed-base tables of different window sizes."""
+    print("=== encrypt with public key tables")
+    spade = SPADE(MODULUS, GENERATOR, n)
+    sks, pks, _, _ = spade.setup()
+    datas = [[random.randint(1, 16) for _ in range(n)] for _ in range(users)]
+    for window in windows:
+        start_time = time.time()
+        pk_tables = [FixedBaseTable(pk, MODULUS, window) for pk in pks] if window else None
+        time_build = time.time() - start_time
+        memory = sum(sys.getsizeof(row) + sum(map(sys.getsizeof, row)) for table in pk_tables or [] for row in table.rows)
+
+        start_time = time.time()
+        for data in datas:
+            spade.encrypt(pks, random.randint(1, MODULUS - 1), data, pk_tables=pk_tables)
+        time_enc = (time.time() - start_time) / users
+        print(f"window={window} | build: {time_build:.4f}s | tables: {memory / (1024 * 1024):.1f} MB | encrypt per user: {time_enc:.4f}s")
+
+def bench_backends(n=1000):
+    """Run setup, encrypt, key derivation and decrypt on every available backend with the same keys and randomness."""
+    print("=== arithmetic backends")
+    outputs = {}
+    sks = random_residues(n)
+    rs = odd_residues(n)
+    alpha = random.randint(1, MODULUS - 1)
+    data = [random.randint(1, 16) for _ in range(n)]
+    for name, backend_class in BACKENDS.items():
+        try:
+            backend = backend_class()
+        except ImportError:
+            print(f"{name}: not installed")
+            continue
+        spade = SPADE(MODULUS, GENERATOR, n, backend=backend)
+        time_setup, pks = timed(lambda: backend.to_ints([spade.g_table.pow(sk) for sk in sks]), repeat=1)
+        reg_key = spade.register(alpha)
+        time_enc, ciphertext = timed(lambda: spade.encrypt(pks, alpha, data, randomness=[spade.g_table.pow(r) for r in rs]), repeat=1)
+        time_kd, dk = timed(spade.key_derivation, 0, 7, sks, reg_key)
+        time_dec, result = timed(spade.decrypt, dk, 7, ciphertext)
+        outputs[name] = (pks, ciphertext, dk, result)
+        print(f"{name:>7} | setup: {time_setup:.4f}s | encrypt: {time_enc:.4f}s | key derivation: {time_kd:.4f}s | decrypt: {time_dec:.4f}s")
+    assert all(output == next(iter(outputs.values())) for output in outputs.values()), "backends give different results"
+
+def bench_pool(n=1000, users=10):
+    """Request-path randomness and encryption time with and without a filled randomness pool."""
+    print("=== encrypt with a randomness pool")
+    spade = SPADE(MODULUS, GENERATOR, n)
+    sks, pks, _, _ = spade.setup()
+    datas = [[random.randint(1, 16) for _ in range(n)] for _ in range(users)]
+
+    def run(take):
+        time_rand = time_enc = 0
+        for data in datas:
+            start_time = time.time()
+            randomness = take(n)
+            time_rand += time.time() - start_time
+            start_time = time.time()
+            spade.encrypt(pks, random.randint(1, MODULUS - 1), data, randomness=randomness)
+            time_enc += time.time() - start_time
+        return time_rand / users, time_enc / users
+
+    time_rand, time_enc = run(spade.encryption_randomness)
+    print(f"n={n:>7} | inline | randomness: {time_rand:.4f}s | encrypt: {time_enc:.4f}s (per user)")
+
+    pool = RandomnessPool(spade, n * users)
+    pool.start()
+    while pool.available < n * users:
+        time.sleep(0.01)
+    time_rand, time_enc = run(pool.take)
+    pool.stop()
+    print(f"n={n:>7} | pool   | randomness: {time_rand:.4f}s | encrypt: {time_enc:.4f}s (per user)")
+
+def bench_random(sizes=(1000, 100000)):
+    """Per-element random draws against the batched CSPRNG vector API."""
+    print("=== randomness: per-element vs batched CSPRNG")
+    for n in sizes:
+        time_mt, _ = timed(lambda: [random.randint(1, MODULUS - 1) for _ in range(n)])
+        time_cs, _ = timed(lambda: [random_element_in_zmod(MODULUS) for _ in range(n)])
+        time_vec, elements = timed(random_elements_in_zmod, MODULUS, n)
+        assert len(elements) == n and all(1 <= x < MODULUS for x in elements)
+        print(f"n={n:>7} | random.randint: {time_mt:.4f}s | secrets per element: {time_cs:.4f}s | random_elements_in_zmod: {time_vec:.4f}s")
+
+def bench_storage(n=1000, users=200):
+    """Database size, insert throughput and query decode time of the JSON and binary ciphertext rows."""
+    print("=== ciphertext storage formats")
+    ciphertexts = [[[c0, c1] for c0, c1 in zip(random_residues(n), random_residues(n))] for _ in range(users)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for ciphertext_format in ("json", "binary"):
+            db_path = os.path.join(tmp_dir, f"{ciphertext_format}.sqlite")
+            db_handler = DBHandler(db_path, "users_cipher", ciphertext_format)
+            db_handler.create_users_cipher_table()
+
+            start_time = time.time()
+            for user_id, ciphertext in enumerate(ciphertexts):
+                db_handler.insert_users_cipher({'id': user_id, 'regKey': b'\x01', 'ciphertext': ciphertext})
+            time_insert = time.time() - start_time
+
+            start_time = time.time()
+            for user_id in range(users):
+                db_handler.get_user_req_by_id(user_id, as_ints=True)
+            time_query = (time.time() - start_time) / users
+
+            rows = [row[0] for row in db_handler.conn.execute("SELECT ciphertext FROM users_cipher")]
+            start_time = time.time()
+            for row in rows:
+                db_handler._deserialize_ciphertext(row, as_ints=True)
+            time_decode = (time.time() - start_time) / users
+            db_handler.close_connection()
+            close_pooled_connections()
+
+            db_size = os.path.getsize(db_path)
+            print(f"{ciphertext_format:>6} | database: {db_size / (1024 * 1024):.2f} MB | insert: {users / time_insert:.0f} users/s | query: {time_query * 1000:.2f} ms per user, of which decode: {time_decode * 1000:.2f} ms")
+
+def bench_memory(sizes=(1000, 100000)):
+    """Memory of one user's ciphertext as lists of [c0, c1] ints and as a CiphertextVector."""
+    print("=== ciphertext memory footprint")
+    for n in sizes:
+        c0s, c1s = random_residues(n), random_residues(n)
+        tracemalloc.start()
+        elements = [[c0 + 0, c1 + 0] for c0, c1 in zip(c0s, c1s)]  # + 0 makes new int objects like encrypt does
+        memory_lists = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        vector = CiphertextVector.from_elements(elements)
+        memory_vector = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"n={n:>7} | lists: {memory_lists / 1024:.0f} KB | CiphertextVector: {memory_vector / 1024:.0f} KB | {memory_lists / memory_vector:.1f}x smaller")
+
+def bench_phases(sizes=(1000, 100000)):
+    """Time the read, decode and decrypt phases of one query on a binary ciphertext row."""
+    print("=== query phases (binary rows)")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n in sizes:
+            spade = SPADE(MODULUS, GENERATOR, n)
+            dk = random_residues(n)
+            ciphertext = CiphertextVector.from_elements([[c0, c1] for c0, c1 in zip(random_residues(n), random_residues(n))])
+            db_handler = DBHandler(os.path.join(tmp_dir, f"phases_{n}.sqlite"), "users_cipher", "binary")
+            db_handler.create_users_cipher_table()
+            db_handler.insert_users_cipher({'id': 1, 'regKey': b'\x01', 'ciphertext': ciphertext})
+
+            time_read, user_req = timed(db_handler.get_user_req_by_id, 1, False, True)
+            time_decode, columns = timed(spade.decode, user_req['ciphertext'])
+            time_decrypt, _ = timed(spade.decrypt_columns, dk, 7, columns)
+            db_handler.close_connection()
+            close_pooled_connections()
+            total = time_read + time_decode + time_decrypt
+            print(f"n={n:>7} | read: {time_read * 1000:.2f} ms | decode: {time_decode * 1000:.2f} ms | decrypt: {time_decrypt * 1000:.2f} ms | decode share: {time_decode / total:.0%}")
+
+def bench_db(n=1000, users=200, threads=4):
+    """Concurrent inserts and queries with one DBHandler per request, like the server does."""
+    print("=== database connections")
+    ciphertext = CiphertextVector.from_elements([[c0, c1] for c0, c1 in zip(random_residues(n), random_residues(n))])
+    pragmas = config.DB_PRAGMAS
+    setups = [("new connection, default pragmas", False, {}), ("new connection, WAL pragmas", False, pragmas), ("pooled, WAL pragmas", True, pragmas)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i, (name, pooled, setup_pragmas) in enumerate(setups):
+            config.DB_PRAGMAS = setup_pragmas
+            db_path = os.path.join(tmp_dir, f"db_{i}.sqlite")
+            DBHandler(db_path, "users_cipher", pooled=False).create_users_cipher_table()
+
+            errors = []
+
+            def worker(user_ids, request):
+                for user_id in user_ids:
+                    db_handler = DBHandler(db_path, "users_cipher", pooled=pooled)
+                    try:
+                        request(db_handler, user_id)
+                    except sqlite3.OperationalError as e:
+                        errors.append(e)  # "database is locked" when a writer waits longer than the 5 s timeout
+                    db_handler.close_connection()
+
+            def run(request):
+                workers = [threading.Thread(target=worker, args=(range(t, users, threads), request)) for t in range(threads)]
+                start_time = time.time()
+                for w in workers:
+                    w.start()
+                for w in workers:
+                    w.join()
+                return time.time() - start_time
+
+            time_insert = run(lambda db_handler, user_id: db_handler.insert_users_cipher({'id': user_id, 'regKey': b'\x01', 'ciphertext': ciphertext}))
+            time_query = run(lambda db_handler, user_id: db_handler.get_user_req_by_id(user_id, as_vector=True))
+            close_pooled_connections()
+            print(f"{name:<32} | insert: {users / time_insert:>6.0f} users/s | query: {users / time_query:>6.0f} users/s | failed: {len(errors)}")
+    config.DB_PRAGMAS = pragmas
+
+def bench_server_db(users=100, requests_count=400, clients=4):
+    """Queries through the threaded Werkzeug server (a new thread per request) with and without pooled connections."""
+    print("=== database connections through the threaded server")
+    import requests
+    from werkzeug.serving import make_server
+    from models import handlers
+    opened = []
+    open_connection = handlers._open_connection
+    handlers._open_connection = lambda db_name: opened.append(db_name) or open_connection(db_name)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # app.py creates config.DbName in the working directory when imported
+        os.chdir(tmp_dir)
+        try:
+            import app as server
+            server.curator = curator = Curator()
+            n = curator.spade.n
+            create_users([(user_id, [random.randint(1, 10) for _ in range(n)]) for user_id in range(users)], n, curator)
+            http_server = make_server("127.0.0.1", 0, server.app, threaded=True)
+            threading.Thread(target=http_server.serve_forever, daemon=True).start()
+            url = f"http://127.0.0.1:{http_server.server_port}/analyst/query_hypno"
+
+            def client(count):
+                session = requests.Session()
+                for _ in range(count):
+                    session.post(url, json={"user_id": random.randrange(users), "query_value": 7, "encoding": "bitmap"}).raise_for_status()
+
+            for pooled in (False, True):
+                config.DB_POOLED = pooled
+                close_pooled_connections()
+                opened.clear()
+                workers = [threading.Thread(target=client, args=(requests_count // clients,)) for _ in range(clients)]
+                start_time = time.time()
+                for w in workers:
+                    w.start()
+                for w in workers:
+                    w.join()
+                elapsed_time = time.time() - start_time
+                print(f"{'pooled' if pooled else 'new connection per request':<27} | {requests_count / elapsed_time:>5.0f} queries/s | connections opened: {len(opened)}")
+            http_server.shutdown()
+        finally:
+            handlers._open_connection = open_connection
+            config.DB_POOLED = True
+            close_pooled_connections()
+            server.db_handler.close_connection()
+            os.chdir(cwd)
+
+def bench_bulk(users=200, workers=(1, os.cpu_count())):
+    """Register users one by one (create_user) against bulk registrations (create_users)."""
+    print("=== bulk registration")
+    curator = Curator()
+    n = curator.spade.n
+    datasets = [[random.randint(1, 10) for _ in range(n)] for _ in range(users)]
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # create_user(s) write to config.DbName in the working directory
+        os.chdir(tmp_dir)
+        try:
+            DBHandler(config.DbName, config.TbName).create_users_cipher_table()
+            start_time = time.time()
+            for user_id, data in enumerate(datasets):
+                create_user(user_id, data, n, curator)
+            time_single = time.time() - start_time
+            print(f"n={n} | create_user:              {users / time_single:.0f} users/s")
+
+            for i, worker_count in enumerate(sorted(set(workers))):
+                offset = (i + 1) * users
+                start_time = time.time()
+                statuses, time_of_enc, time_of_insert = create_users([(offset + user_id, data) for user_id, data in enumerate(datasets)], n, curator, worker_count)
+                time_bulk = time.time() - start_time
+                assert all(status['status'] == "success" for status in statuses)
+                print(f"n={n} | create_users, {worker_count} worker(s): {users / time_bulk:.0f} users/s (encrypt: {time_of_enc:.2f}s, insert: {time_of_insert:.2f}s)")
+        finally:
+            close_pooled_connections()
+            curator.close_shared_keys()
+            os.chdir(cwd)
+
+def bench_query_many(users=200, workers=(1, os.cpu_count())):
+    """Query users one by one (one SELECT each) against one streamed SELECT with query_users."""
+    print("=== multi-user query")
+    curator = Curator()
+    n = curator.spade.n
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            DBHandler(config.DbName, config.TbName).create_users_cipher_table()
+            create_users([(user_id, [random.randint(1, 10) for _ in range(n)]) for user_id in range(users)], n, curator)
+
+            start_time = time.time()
+            for user_id in range(users):
+                db_handler = DBHandler(config.DbName, config.TbName)
+                user_req = db_handler.get_user_req_by_id(user_id, as_vector=True)
+                db_handler.close_connection()
+                decrypt_user(curator.spade, curator.sks, user_req, 7, curator.get_kd_base(user_id))
+            time_single = time.time() - start_time
+            print(f"n={n} | one by one:                 {users / time_single:.0f} users/s")
+
+            for worker_count in sorted(set(workers)):
+                start_time = time.time()
+                db_handler = DBHandler(config.DbName, config.TbName)
+                results = list(query_users(curator, db_handler.iter_user_reqs(None, 0, users - 1), 7, worker_count))
+                time_many = time.time() - start_time
+                assert len(results) == users and all(error is None for _, _, error in results)
+                print(f"n={n} | query_users, {worker_count} worker(s): {users / time_many:.0f} users/s")
+
+                start_time = time.time()
+                aggregates = aggregate_users(curator, db_handler.iter_user_reqs(None, 0, users - 1), 7, worker_count)
+                time_aggregate = time.time() - start_time
+                print(f"n={n} | aggregate_users, {worker_count} worker(s): {users / time_aggregate:.0f} users/s")
+
+            size_results = len(json.dumps([{"user_id": user_id, "decrypted_result": decrypted} for user_id, decrypted, _ in results]))
+            size_aggregates = len(json.dumps(aggregates))
+            print(f"response size | decrypted results: {size_results / 1024:.0f} KB | aggregates: {size_aggregates} B")
+        finally:
+            close_pooled_connections()
+            curator.close_shared_keys()
+            os.chdir(cwd)
+
+def bench_encodings(n=1000, match_rate=0.1):
+    """
+    Response size and time of one query result in every encoding: the serialization alone
+    (encoding + json.dumps) and together with the decryption (the compact encodings decrypt with matches=True).
+    """
+    print("=== result encodings")
+    spade = SPADE(MODULUS, GENERATOR, n)
+    dk = random_residues(n)
+    columns = [random_residues(n), random_residues(n)]
+    decrypted = [1 if random.random() < match_rate else value for value in random_residues(n)]
+    matches = [value == 1 for value in decrypted]
+    baseline = None
+    for encoding in ENCODINGS:
+        if encoding == "list":
+            time_serialize, payload = timed(lambda: json.dumps({"decrypted_result": decrypted}), repeat=20)
+            time_total, _ = timed(lambda: json.dumps({"decrypted_result": spade.decrypt_columns(dk, 7, columns)}), repeat=5)
+            baseline = (len(payload), time_serialize, time_total)
+        else:
+            time_serialize, payload = timed(lambda: json.dumps({"encoded_result": encode_result(matches, encoding)}), repeat=20)
+            time_total, _ = timed(lambda: json.dumps({"encoded_result": encode_result(spade.decrypt_columns(dk, 7, columns, True), encoding)}), repeat=5)
+        print(f"n={n} | {encoding:>9}: {len(payload):>6} B ({baseline[0] / len(payload):>3.0f}x smaller) | serialize: {time_serialize * 1000:.3f} ms ({baseline[1] / time_serialize:.1f}x) | decrypt + serialize: {time_total * 1000:.3f} ms ({baseline[2] / time_total:.2f}x)")
+
+def bench_values(n=1000, values=range(1, 11)):
+    """One query per value (re-reading and re-decoding the row each time) against one decrypt_values query."""
+    print("=== multi-value query")
+    spade = SPADE(MODULUS, GENERATOR, n)
+    sks, pks, _, _ = spade.setup()
+    alpha = random_element_in_zmod(MODULUS)
+    reg_key = spade.register(alpha)
+    data = [random.choice(values) for _ in range(n)]
+    ciphertext = spade.encrypt(pks, alpha, data, reg_key=reg_key)
+    kd_base = spade.key_derivation_base(sks, reg_key)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_handler = DBHandler(os.path.join(tmp_dir, "values.sqlite"), "users_cipher")
+        db_handler.create_users_cipher_table()
+        db_handler.insert_users_cipher({'id': 1, 'regKey': b'\x01', 'ciphertext': ciphertext})
+
+        def per_value():
+            results = {}
+            for value in values:
+                user_req = db_handler.get_user_req_by_id(1, as_vector=True)
+                dk = spade.key_derivation(1, value, sks, reg_key, kd_base)
+                results[value] = spade.decrypt_columns(dk, value, spade.decode(user_req['ciphertext']), True)
+            return results
+
+        def all_values():
+            user_req = db_handler.get_user_req_by_id(1, as_vector=True)
+            return spade.decrypt_values(values, sks, reg_key, user_req['ciphertext'], kd_base)
+
+        time_per_value, res_per_value = timed(per_value)
+        time_all, res_all = timed(all_values)
+        close_pooled_connections()
+    assert res_per_value == res_all, "decrypt_values result differs from the per-value queries"
+    print(f"n={n} | {len(values)} values | one query per value: {time_per_value * 1000:.2f} ms | decrypt_values: {time_all * 1000:.2f} ms | speedup: {time_per_value / time_all:.1f}x")
+
+def bench_setup_workers(n=100000, workers=(1, 2, 4)):
+    """SPADE.setup with the public keys computed by different numbers of worker processes."""
+    print(f"=== setup workers ({os.cpu_count()} CPUs)")
+    spade = SPADE(MODULUS, GENERATOR, n)
+    reports = []
+    for count in workers:
+        sks, pks, time_setup, peak_memory = spade.setup(count, progress=lambda done, total: reports.append(done))
+        assert pks == [pow(GENERATOR, sk, MODULUS) for sk in sks[:100]] + pks[100:], "setup public keys differ from g^sk"
+        assert reports[-1] == n, "progress didn't reach the vector size"
+        print(f"n={n} | workers: {count} | setup: {time_setup:.4f}s | progress reports: {len(reports)} | peak memory: {peak_memory / 1024:.0f} KB")
+        reports.clear()
+
+def bench_shared_keys(n=1000, window=8, workers=2):
+    """Per-worker cost of the keys: a pickled copy (and rebuilt public key tables) against attaching to the shared keystore."""
+    print("=== shared keys for worker processes")
+    import pickle
+    from models.keystore import Keystore
+    spade = SPADE(MODULUS, GENERATOR, n)
+    sks, pks, _, _ = spade.setup()
+    time_build, pk_tables = timed(lambda: [FixedBaseTable(pk, MODULUS, window) for pk in pks], repeat=1)
+    copied = len(pickle.dumps((sks, pks)))
+    print(f"n={n} w={window} | copy: {copied / 1024:.0f} KB pickled and {time_build:.2f}s of table building per worker")
+
+    start_time = time.time()
+    shm = Keystore.share(MODULUS, GENERATOR, sks, pks, pk_tables)
+    time_share = time.time() - start_time
+    try:
+        def attach():
+            keystore = Keystore(shm.name, shared=True)
+            tables = keystore.pk_tables(spade.backend)
+            assert tables[-1].pow(12345) == pk_tables[-1].pow(12345) and keystore.sks[-1] == sks[-1]
+            keystore.close()
+        time_attach, _ = timed(attach)
+        print(f"n={n} w={window} | shared: {shm.size / 2**20:.1f} MB once ({time_share:.2f}s), {time_attach * 1000:.2f} ms to attach per worker")
+    finally:
+        shm.close()
+        shm.unlink()
+
+    # Bulk registration where the workers attach to the curator's shared keys
+    curator = Curator()
+    curator.build_pk_tables(window)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            DBHandler(config.DbName, config.TbName).create_users_cipher_table()
+            users = [(user_id, [random.randint(1, 10) for _ in range(curator.spade.n)]) for user_id in range(50)]
+            start_time = time.time()
+            statuses, _, _ = create_users(users, curator.spade.n, curator, workers)
+            time_bulk = time.time() - start_time
+            assert all(status['status'] == "success" for status in statuses)
+            print(f"n={curator.spade.n} w={window} | create_users, {workers} workers on shared keys: {len(users) / time_bulk:.0f} users/s")
+        finally:
+            close_pooled_connections()
+            curator.close_shared_keys()
+            os.chdir(cwd)
+
+BENCHMARKS = {
+    "decrypt": bench_decrypt,
+    "encrypt": bench_encrypt,
+    "setup": bench_setup,
+    "setup_workers": bench_setup_workers,
+    "pk_tables": bench_pk_tables,
+    "backends": bench_backends,
+    "pool": bench_pool,
+    "random": bench_random,
+    "storage": bench_storage,
+    "memory": bench_memory,
+    "phases": bench_phases,
+    "db": bench_db,
+    "server_db": bench_server_db,
+    "bulk": bench_bulk,
+    "shared_keys": bench_shared_keys,
+    "query_many": bench_query_many,
+    "encodings": bench_encodings,
+    "values": bench_values,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -0,0 +1,105 @@
+# ciphertext.py
+import config
+
+# Residues mod q fit in the byte length of q (17 bytes for the 129-bit config.MODULUS)
+CT_LIMB_SIZE = (config.MODULUS.bit_length() + 7) // 8
+
+class CiphertextVector:
+    __slots__ = ("_base", "_offset", "width", "limb_size", "_count")
+
+    def __init__(self, buffer, width=2, limb_size=CT_LIMB_SIZE, offset=0, count=None):
+        """
+        Ciphertext vector backed by one contiguous buffer of fixed-width big-endian limbs,
+        element after element ([c0, c1] or [c0, c1, c0_inv], `width` values per element).
+        The vector starts at `offset` of `buffer` and the buffer is not copied, so the raw
+        bytes of a database row can be used as is.
+        """
+        if isinstance(buffer, memoryview):
+            buffer = buffer.obj if buffer.nbytes == len(buffer.obj) else buffer.tobytes()
+        self._base = buffer
+        self._offset = offset
+        self.width = width
+        self.limb_size = limb_size
+        if count is None:
+            count = (len(buffer) - offset) // (width * limb_size)
+        self._count = count
+
+    @classmethod
+    def from_elements(cls, elements, width=None, limb_size=CT_LIMB_SIZE):
+        """Pack a list of [c0, c1] (or [c0, c1, c0_inv]) int elements."""
+        if width is None:
+            width = len(elements[0]) if elements else 2
+        buffer = b''.join(c.to_bytes(limb_size, byteorder='big') for element in elements for c in element)
+        return cls(buffer, width, limb_size)
+
+    @property
+    def buffer(self):
+        """The vector's part of the buffer as a memoryview (no copy)."""
+        return memoryview(self._base)[self._offset:self._offset + self.nbytes]
+
+    @property
+    def nbytes(self):
+        return self._count * self.width * self.limb_size
+
+    def __len__(self):
+        return self._count
+
+    def value(self, i, k):
+        """The k-th value (0 = c0, 1 = c1, 2 = c0_inv) of element i as an int."""
+        start = self._offset + (i * self.width + k) * self.limb_size
+        return int.from_bytes(self._base[start:start + self.limb_size], byteorder='big')
+
+    def column(self, k):
+        """The k-th value of every element as a list of ints (e.g. all c0 for k = 0)."""
+        size = self.limb_size
+        base = self._base
+        start = self._offset + k * size
+        end = self._offset + self.nbytes
+        return [int.from_bytes(base[i:i + size], byteorder='big') for i in range(start, end, self.width * size)]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._count)
+            element_size = self.width * self.limb_size
+            if step == 1:
+                # Zero-copy view on the same buffer
+                return CiphertextVector(self._base, self.width, self.limb_size,
+                                        self._offset + start * element_size, max(0, stop - start))
+            return CiphertextVector.from_elements([self[i] for i in range(start, stop, step)], self.width, self.limb_size)
+
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("ciphertext index out of range")
+        return tuple(self.value(index, k) for k in range(self.width))
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self[i]
+
+    def to_list(self):
+        """The elements as a list of lists of ints."""
+        columns = [self.column(k) for k in range(self.width)]
+        return [list(element) for element in zip(*columns)]
+
+    def __eq__(self, other):
+        if isinstance(other, CiphertextVector):
+            if (self.width, self.limb_size) == (other.width, other.limb_size):
+                return self.buffer == other.buffer
+            return self.to_list() == other.to_list()
+        try:
+            return self.to_list() == [list(element) for element in other]
+        except TypeError:
+            return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"CiphertextVector({self.to_list()})"
+
+
+def ciphertext_columns(ciphertexts, width):
+    """The first `width` value columns of a CiphertextVector or a list of elements, as lists of ints."""
+    if isinstance(ciphertexts, CiphertextVector):
+        return [ciphertexts.column(k) for k in range(width)]
+    return [[ci[k] for ci in ciphertexts] for k in range(width)]
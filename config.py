@@ -4,13 +4,61 @@ MODULUS = 340282366920938463463374607431768211507  # Example prime modulus
 GENERATOR = 2  # Example generator
 MAX_PT_VEC_SIZE = 1000  # Max plaintext vector size, sets the mpk ans msk also to this size
 
+# Big-integer arithmetic backend: "auto" (gmpy2 if installed), "python" or "gmpy2"
+ARITH_BACKEND = "auto"
+
+# Store c0^-1 next to each ciphertext element (ciphertext version 2), makes decryption faster
+STORE_C0_INVERSE = False
+
+# Window size of the curator's per-public-key fixed-base tables (0 = no tables)
+# Memory per key is about ceil(131 / w) * 2^w integers: w=4 ~27 KB, w=6 ~70 KB, w=8 ~216 KB
+PK_TABLE_WINDOW = 0
+
+# Background pool of precomputed encryption randomness (0 = no pool, values are drawn inside the request)
+RANDOMNESS_POOL_SIZE = 0  # Buffered values, e.g. 10 * MAX_PT_VEC_SIZE covers a burst of 10 registrations
+RANDOMNESS_POOL_WORKERS = 1
+
+# Worker processes computing the public keys at curator setup (0 = one per CPU, 1 = no worker processes)
+SETUP_WORKERS = 0
+
+# Worker processes encrypting the users of a bulk registration (0 = one per CPU, 1 = no worker processes)
+BULK_WORKERS = 0
+
+# Worker processes decrypting the users of a multi-user query (0 = one per CPU, 1 = no worker processes)
+QUERY_WORKERS = 0
+QueryBatchSize = 256  # Rows fetched from the database at a time by multi-user queries
+
+# Production server (serve.py): worker processes for the encryptions and decryptions (0 = one per CPU)
+# and request threads, the threads only read and write the database and wait for the workers
+SERVER_WORKERS = 0
+SERVER_THREADS = 16
+
 # Database configurations
 DbName = "database.sqlite"
 TbName = "users_cipher"
+CIPHERTEXT_FORMAT = "binary"  # Format of new ciphertext rows: "binary" (fixed-width limbs) or "json" (hex strings)
+DB_POOLED = True  # Reuse open connections between DBHandlers instead of opening one per DBHandler
+DB_POOL_SIZE = 8  # Idle pooled connections kept open per database
+DB_PRAGMAS = {
+    "journal_mode": "WAL",   # Readers don't block the writer
+    "synchronous": "NORMAL", # With WAL, no fsync on every commit (only at checkpoints)
+    "cache_size": -16000,    # 16 MB page cache per connection
+    "mmap_size": 268435456,  # Read the database through a 256 MB memory map
+}
+
+# Curator keystore file ("" = new keys on every start and the database is removed on exit).
+# With a keystore the keys are saved (readable only by the owner, they are secret), loaded on
+# the next start and the database is kept, so the server restarts without re-registering users.
+# The key derivation bases of the users are added to it at registration.
+KEYSTORE_FILE = ""  # e.g. "curator.keystore"
 
 # Number of users for the testing files (hypnogram.py, dna.py, test_app.py)
 NumUsers = 10
 
+# Domain values of the usecases (query "all" values), the hypnogram stages and the mapped dinucleotides
+HYPNO_VALUES = list(range(1, 11))
+DNA_VALUES = list(range(1, 17))
+
 # Padding configurations
 PaddingItem = 20    # DNA goes to 16, hypnogram to 10, so 20 works
 
@@ -22,6 +70,11 @@ BASE_URL_ENCRYPT_HYPNO = "http://localhost:5000/hypnogram/register"
 BASE_URL_QUERY_HYPNO = "http://localhost:5000/analyst/query_hypno"
 BASE_URL_ENCRYPT_DNA = "http://localhost:5000/dna/register"
 BASE_URL_QUERY_DNA = "http://localhost:5000/analyst/query_dna"
+BASE_URL_BULK_REGISTER = "http://localhost:5000/register/bulk"
+BASE_URL_QUERY_MANY = "http://localhost:5000/analyst/query_many"
+BASE_URL_AGGREGATE = "http://localhost:5000/analyst/aggregate"
+BASE_URL_QUERY_VALUES = "http://localhost:5000/analyst/query_values"
+BulkBatchSize = 500  # Users per bulk registration request
 
 # Directories
 HYPNO_DIR = './datasets/hypnogram'
@@ -0,0 +1,74 @@
+# fixed_base.py
+from math import ceil
+from backend import PythonBackend
+
+class FixedBaseTable:
+    def __init__(self, base, modulus, window=8, max_bits=None, backend=None, rows=None):
+        """
+        Precompute a fixed-base comb table for `base` mod `modulus`.
+        Row j holds base^(d * 2^(window*j)) for every window digit d, so base^e is the
+        product of one table entry per window of e (17 multiplications for a 129-bit
+        exponent with window 8) instead of a full square-and-multiply exponentiation.
+        The entries are numbers of `backend` (Python ints by default). Already computed
+        `rows` (e.g. from the curator keystore) are used as they are.
+        """
+        self.backend = backend or PythonBackend()
+        self.q = self.backend.mpz(modulus)
+        self.base = self.backend.mpz(base) % self.q
+        self.window = window
+        # Exponents like r + alpha can be a couple of bits longer than the modulus
+        max_bits = max_bits or modulus.bit_length() + 2
+        self.num_rows = ceil(max_bits / window)
+        self.max_exp = 1 << (self.num_rows * window)
+        # With base 2 multiplying by the base is a shift
+        self.is_two = self.base == 2
+        self.rows = rows if rows is not None else self._build_rows()
+
+    def _build_rows(self):
+        q = self.q
+        size = 1 << self.window
+        rows = []
+        row_base = self.base
+        for _ in range(self.num_rows):
+            row = [self.backend.mpz(1)] * size
+            if row_base == 2:
+                for d in range(1, size):
+                    v = row[d - 1] << 1
+                    row[d] = v - q if v >= q else v
+            else:
+                for d in range(1, size):
+                    row[d] = (row[d - 1] * row_base) % q
+            rows.append(row)
+            # The next row starts from base^(2^(window*(j+1)))
+            row_base = (row[size - 1] * row_base) % q
+        return rows
+
+    def _digits(self, exponent):
+        """Split the exponent into window-sized digits, least significant first."""
+        if self.window == 8:
+            return exponent.to_bytes(self.num_rows, byteorder='little')
+        mask = (1 << self.window) - 1
+        digits = []
+        for _ in range(self.num_rows):
+            digits.append(exponent & mask)
+            exponent >>= self.window
+        return digits
+
+    def pow(self, exponent):
+        """
+        Return base^exponent mod q. Negative or too long exponents use the backend's powmod.
+        """
+        if exponent < 0 or exponent >= self.max_exp:
+            return self.backend.powmod(self.base, exponent, self.q)
+
+        q = self.q
+        digits = self._digits(exponent)
+        if self.is_two:
+            # The first row of base 2 is 2^d, a plain shift
+            result = (1 << digits[0]) % q
+        else:
+            result = self.rows[0][digits[0]]
+        for row, d in zip(self.rows[1:], digits[1:]):
+            if d:
+                result = (result * row[d]) % q
+        return result
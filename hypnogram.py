@@ -1,10 +1,11 @@
 import random
 import requests
+import sys
 import string
 import time
 import json
 import utils
-from config import MAX_PT_VEC_SIZE, NumUsers
+from config import MAX_PT_VEC_SIZE, NumUsers, BASE_URL_BULK_REGISTER, BulkBatchSize
 
 # Define constants for the API endpoint
 BASE_URL_ENCRYPT = "http://localhost:5000/hypnogram/register"
@@ -127,5 +128,33 @@ def run_performance_tests():
     print(f"Total memory allecations for key derivation: {total_memory_kd / 1024:.2f} KB")
     print(f"Total memory allecations for decryption: {total_memory_dec / 1024:.2f} KB\n")
 
+# Register the whole dataset (up to config.MaxFiles files) with bulk registration requests
+def load_dataset_bulk(batch_size=BulkBatchSize):
+    hypnogram_data = utils.process_hypnogram_files(HYPNO_DIR)
+    headers = {
+        'Content-Type': 'application/json'
+    }
+
+    start_time = time.time()
+    registered = 0
+    for start in range(0, len(hypnogram_data), batch_size):
+        users = [{'user_id': user_id, 'data': data} for user_id, data in enumerate(hypnogram_data[start:start + batch_size], start)]
+        response = requests.post(BASE_URL_BULK_REGISTER, headers=headers, json={'users': users})
+        responseJson = response.json()
+        if response.status_code == 200:
+            failed = [result for result in responseJson['results'] if result['status'] != "success"]
+            registered += len(users) - len(failed)
+            for result in failed:
+                print(f"Failed registration for User {result['user_id']} | Error: {result['message']}")
+            print(f"Users {start}-{start + len(users) - 1} | Time of enc: {responseJson.get('time_of_enc'):.4f}s | Time of insert: {responseJson.get('time_of_insert'):.4f}s")
+        else:
+            print(f"Failed bulk request for Users {start}-{start + len(users) - 1} | Status Code: {response.status_code} | Error: {responseJson.get('message')}")
+
+    elapsed_time = time.time() - start_time
+    print(f"Registered {registered} of {len(hypnogram_data)} users in {elapsed_time:.2f}s")
+
 if __name__ == '__main__':
-    run_performance_tests()
\ No newline at end of file
+    if "--bulk" in sys.argv:
+        load_dataset_bulk()
+    else:
+        run_performance_tests()
\ No newline at end of file
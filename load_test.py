@@ -0,0 +1,57 @@
+import argparse
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import config
+
+# Local load test of a running server (python serve.py, or python app.py):
+#   python load_test.py [--clients N] [--users N] [--first-id ID] [--url http://localhost:5000]
+# Registers the users from concurrent clients and then queries every user, and reports
+# the throughput and the latencies of both phases.
+
+def timed_post(session, url, payload):
+    start_time = time.time()
+    try:
+        response = session.post(url, json=payload)
+        ok = response.status_code == 200 and response.json().get("status") == "success"
+    except requests.RequestException:
+        ok = False
+    return time.time() - start_time, ok
+
+def run_phase(name, url, payloads, clients):
+    """POST every payload to `url` from `clients` threads (one session each) and print the results."""
+    sessions = [requests.Session() for _ in range(clients)]
+    start_time = time.time()
+    with ThreadPoolExecutor(clients) as executor:
+        results = list(executor.map(lambda i: timed_post(sessions[i % clients], url, payloads[i]), range(len(payloads))))
+    elapsed_time = time.time() - start_time
+
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(not ok for _, ok in results)
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+    print(f"{name:<9} | {len(payloads)} requests from {clients} clients in {elapsed_time:.2f}s | "
+          f"{len(payloads) / elapsed_time:.1f} req/s | p50: {percentile(0.5):.0f} ms | p95: {percentile(0.95):.0f} ms | "
+          f"max: {latencies[-1] * 1000:.0f} ms | errors: {errors}")
+    return errors
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent registrations and queries against the server.")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--first-id", type=int, default=100000, help="user id of the first test user")
+    parser.add_argument("--url", default="http://localhost:5000")
+    args = parser.parse_args()
+
+    user_ids = range(args.first_id, args.first_id + args.users)
+    registrations = [{"user_id": user_id, "data": [random.randint(1, 10) for _ in range(config.MAX_PT_VEC_SIZE)]}
+                     for user_id in user_ids]
+    queries = [{"user_id": user_id, "query_value": random.randint(1, 10), "encoding": "bitmap"} for user_id in user_ids]
+
+    errors = run_phase("register", f"{args.url}/hypnogram/register", registrations, args.clients)
+    errors += run_phase("query", f"{args.url}/analyst/query_hypno", queries, args.clients)
+    if errors:
+        print(f"{errors} request(s) failed")
+
+if __name__ == "__main__":
+    main()
@@ -1,63 +1,147 @@
-import time
-import requests
-from math import gcd
-import utils  # Assuming you still need to use utility functions
-from spade import SPADE
-from models.handlers import PBHandler
-from config import MAX_PT_VEC_SIZE
+import stats
+import result_codec
 
 # Assuming the Analyst class interacts with an external SPADE instance, we can keep this as-is
 class Analyst:      
     def __init__(self, name):
         self.name = name
 
-    def query_data(self, user_id, query_value, URL):
+    def query_data(self, user_id, query_value, URL, aggregation=None, encoding="bitmap"):
+        """
+        Query the decrypted data of the user. With `aggregation` ("count", "transitions", "sequences"
+        or "all") the server computes the statistics and only they are returned, as a dict.
+        Otherwise the result is sent with `encoding` (see result_codec) and decoded here into
+        a list with 1 at the positions that match the query value (all values with "list").
+        """
         payload = {
         'user_id': user_id,
-        'query_value': query_value
+        'query_value': query_value,
+        'encoding': encoding
         }
+        if aggregation:
+            payload['aggregation'] = aggregation
 
         headers = {
             'Content-Type': 'application/json'
         }
 
+        import requests
         response = requests.post(URL, headers=headers, json=payload)
         responseJson = response.json()
+        if aggregation:
+            return responseJson.get('aggregates')
+        if 'encoded_result' in responseJson:
+            return result_codec.decode_result(responseJson['encoded_result'])
         decrypted_data = responseJson.get('decrypted_result')
         return decrypted_data
 
+    def query_many(self, user_ids, query_value, URL, first_id=None, last_id=None, aggregation=None, encoding="bitmap"):
+        """
+        Query many users with one request: the users in `user_ids`, or the range `first_id` to `last_id`.
+        Returns the decrypted data of every found user as {user_id: decrypted_data},
+        or the statistics of every user with `aggregation` (see query_data).
+        """
+        payload = {
+        'query_value': query_value,
+        'encoding': encoding
+        }
+        if aggregation:
+            payload['aggregation'] = aggregation
+        if user_ids is not None:
+            payload['user_ids'] = list(user_ids)
+        else:
+            payload['first_id'] = first_id
+            payload['last_id'] = last_id
+
+        headers = {
+            'Content-Type': 'application/json'
+        }
+
+        import requests
+        response = requests.post(URL, headers=headers, json=payload)
+        responseJson = response.json()
+        results = {}
+        for result in responseJson.get('results', []):
+            if result['status'] != "success":
+                continue
+            if aggregation:
+                results[result['user_id']] = result['aggregates']
+            elif 'encoded_result' in result:
+                results[result['user_id']] = result_codec.decode_result(result['encoded_result'])
+            else:
+                results[result['user_id']] = result['decrypted_result']
+        return results
+
+    def aggregate(self, query_value, URL, user_ids=None, first_id=None, last_id=None):
+        """
+        Population aggregates of the value computed on the server (total count, histogram of the
+        per-user counts and mean run length) over the users in `user_ids`, the range `first_id`
+        to `last_id`, or all users. Only the aggregates are sent back, not the decrypted data.
+        """
+        payload = {
+        'query_value': query_value,
+        'user_ids': list(user_ids) if user_ids is not None else None,
+        'first_id': first_id,
+        'last_id': last_id
+        }
+
+        headers = {
+            'Content-Type': 'application/json'
+        }
+
+        import requests
+        response = requests.post(URL, headers=headers, json=payload)
+        responseJson = response.json()
+        # JSON object keys are strings, the histogram counts are ints
+        histogram = {int(count): users for count, users in responseJson.get('histogram', {}).items()}
+        return {
+            'users': responseJson.get('users'),
+            'total_count': responseJson.get('total_count'),
+            'histogram': histogram,
+            'mean_run_length': responseJson.get('mean_run_length')
+        }
+
+    def query_values(self, user_id, values, URL, domain="hypnogram"):
+        """
+        Query several values of the user with one request: `values` is a list, or "all" for every
+        value of the `domain` ("hypnogram" or "dna"). Returns the histogram ({value: count}),
+        the sorted values and the transition matrix between them (see stats.histogram_and_transitions).
+        """
+        payload = {
+        'user_id': user_id,
+        'values': values,
+        'domain': domain
+        }
+
+        headers = {
+            'Content-Type': 'application/json'
+        }
+
+        import requests
+        response = requests.post(URL, headers=headers, json=payload)
+        responseJson = response.json()
+        # JSON object keys are strings, the values are ints
+        histogram = {int(value): count for value, count in responseJson.get('histogram', {}).items()}
+        return {
+            'values': responseJson.get('values'),
+            'histogram': histogram,
+            'transition_matrix': responseJson.get('transition_matrix')
+        }
+
     def count_the_value(self, decrypted_data):
         """
         Count the amount of the value (1 since the query values is 1 in the decryption) in the data
         """
-        return decrypted_data.count(1)
+        return stats.count_the_value(decrypted_data)
     
     def count_transitions(self, decrypted_data):
         """
         Count how many times the value (1 since the query values is 1 in the decryption) jumps to other values in the hypnogram's values.
         """
-        transitions = 0
-        for i in range(len(decrypted_data) - 1):
-            if decrypted_data[i] == 1 and decrypted_data[i + 1] != 1:
-                transitions += 1
-        return transitions
+        return stats.count_transitions(decrypted_data)
 
     def count_sequences(self, decrypted_data):
         """
         Count how many distinct sequences of the value (1 since the query values is 1 in the decryption) appear in the hypnogram's values.
         """
-        sequences = 0
-        in_sequence = False
-        for value in decrypted_data:
-            if value == 1:
-                if not in_sequence:  # Start of a new sequence
-                    sequences += 1
-                    in_sequence = True
-            else:
-                in_sequence = False  # End of the current sequence
-        return sequences
-
-
-
-
-
+        return stats.count_sequences(decrypted_data)
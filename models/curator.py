@@ -1,9 +1,9 @@
-from spade import SPADE
+from spade import SPADE, SETUP_CHUNK_SIZE
+from fixed_base import FixedBaseTable
+from models.keystore import Keystore, SharedKdBases
 import config
-import utils
 import os
-import logging
-from Crypto.PublicKey import RSA
+import threading
 import time
 
 class Curator:
@@ -16,20 +16,159 @@ class Curator:
         self.setup_memory = 0
         self.reg_keys = []  # Registration keys !!! IN DATABASE
         self.ciphertexts = []  # Encrypted data !!! IN DATABASE
+        self.pk_tables = None  # Optional fixed-base tables of the public keys
+        self.randomness_pool = None  # Optional pool of precomputed encryption randomness
+        self.kd_bases = {}  # Per-user reg_key^(-sk_i) vectors, secret like the sks so NOT in database (but in the keystore)
+        self.keystore = None  # Keystore the keys were loaded from
+        self.keystore_path = config.KEYSTORE_FILE or None  # Keystore file the new key derivation bases are added to
+        self._keystore_lock = threading.Lock()
+        self.shared_keys = None  # Shared memory block of the keys and tables for worker processes
+        self.shared_kd_bases = None  # Key derivation bases in shared memory for worker processes
+        self.worker_pool = None  # Optional pool of worker processes for the CPU-bound work of the server
         self.spade = SPADE(self.q, self.g, config.MAX_PT_VEC_SIZE)
         self.num_users = config.NumUsers
-        self.generate_keys()
+        if config.KEYSTORE_FILE and os.path.exists(config.KEYSTORE_FILE):
+            self.load_keystore(config.KEYSTORE_FILE)
+        else:
+            self.generate_keys()
+            if config.KEYSTORE_FILE:
+                self.save_keystore(config.KEYSTORE_FILE)
 
     def generate_keys(self):
         """
         Generates public and secret keys using SPADE.
         """
         # Generate public and private keys
-        self.sks, self.pks, self.setup_time, self.setup_memory = self.spade.setup()
+        self.sks, self.pks, self.setup_time, self.setup_memory = self.spade.setup(config.SETUP_WORKERS, progress=self._setup_progress)
+        if config.PK_TABLE_WINDOW:
+            self.build_pk_tables(config.PK_TABLE_WINDOW)
+        if config.RANDOMNESS_POOL_SIZE:
+            self.start_randomness_pool(config.RANDOMNESS_POOL_SIZE, config.RANDOMNESS_POOL_WORKERS)
         
         # Generate registration keys (can be random or based on some logic)
         # self.reg_keys = [utils.random_element_in_zmod(self.q) for _ in range(self.num_users)]
 
+    def _setup_progress(self, done, total):
+        # Printed like the rest of the startup output, a setup of one chunk is quick enough without it
+        if total > SETUP_CHUNK_SIZE:
+            print(f"Curator setup: {done}/{total} public keys")
+
+    def load_keystore(self, path):
+        """
+        Loads the keys, the public key tables and the key derivation bases from the keystore file
+        (memory-mapped, the tables and the bases are read when used) instead of generating new keys.
+        """
+        start_time = time.time()
+        keystore = Keystore(path)
+        if (keystore.q, keystore.g, keystore.n) != (self.q, self.g, self.spade.n):
+            keystore.close()
+            raise ValueError(f"Keystore {path} doesn't match the configured MODULUS, GENERATOR and MAX_PT_VEC_SIZE!")
+        self.keystore = keystore
+        self.sks, self.pks = keystore.sks, keystore.pks
+        if config.PK_TABLE_WINDOW:
+            if keystore.window == config.PK_TABLE_WINDOW:
+                self.pk_tables = keystore.pk_tables(self.spade.backend)
+            else:
+                self.build_pk_tables(config.PK_TABLE_WINDOW)
+        self.setup_time = time.time() - start_time
+        self.setup_memory = 0
+        if config.RANDOMNESS_POOL_SIZE:
+            self.start_randomness_pool(config.RANDOMNESS_POOL_SIZE, config.RANDOMNESS_POOL_WORKERS)
+
+    def save_keystore(self, path):
+        """
+        Saves the keys, the public key tables and the key derivation bases to the keystore file.
+        """
+        Keystore.save(path, self.q, self.g, self.sks, self.pks, self.kd_bases, self.pk_tables, self.keystore)
+
+    def share_keys(self):
+        """
+        Returns the name of the shared memory block holding the keys and the public key tables
+        (see Keystore.share), created on the first call. Worker processes attach to it read-only
+        with Keystore(name, shared=True) instead of getting a copy of the keys.
+        """
+        if self.shared_keys is None:
+            self.shared_keys = Keystore.share(self.q, self.g, self.sks, self.pks, self.pk_tables, self.keystore)
+        return self.shared_keys.name
+
+    def share_kd_base(self, user_id):
+        """
+        Returns the location of the user's key derivation base in shared memory (see SharedKdBases),
+        None if it has not been computed. Worker processes get the location instead of a copy of the base.
+        The base is moved there: the shared block is then the only copy the curator keeps.
+        """
+        with self._keystore_lock:
+            if self.shared_kd_bases is None:
+                self.shared_kd_bases = SharedKdBases(self.spade.n, (self.q.bit_length() + 7) // 8)
+        location = self.shared_kd_bases.location(user_id)
+        if location is None:
+            kd_base = self.kd_bases.get(user_id)
+            if kd_base is None and self.keystore is not None:
+                kd_base = self.keystore.kd_base(user_id)
+            if kd_base is not None:
+                location = self.shared_kd_bases.put(user_id, kd_base)
+                # Released only once the shared copy can be read
+                self.kd_bases.pop(user_id, None)
+        return location
+
+    def close_shared_keys(self, keep_kd_bases=True):
+        """
+        Removes the shared memory blocks of the keys and the key derivation bases (the attached workers must be stopped first).
+        The bases that were moved to shared memory are copied back, unless `keep_kd_bases` is False (e.g. at exit).
+        """
+        if self.shared_keys is not None:
+            self.shared_keys.close()
+            self.shared_keys.unlink()
+            self.shared_keys = None
+        if self.shared_kd_bases is not None:
+            if keep_kd_bases:
+                for user_id in self.shared_kd_bases.user_ids():
+                    self.kd_bases.setdefault(user_id, self.shared_kd_bases.get(user_id))
+            self.shared_kd_bases.close()
+            self.shared_kd_bases = None
+
+    def build_pk_tables(self, window):
+        """
+        Builds a fixed-base table for every public key, reused by the encryption of every user.
+        Bigger windows are faster but take more memory (see config.PK_TABLE_WINDOW).
+        """
+        self.pk_tables = [FixedBaseTable(pk, self.q, window, backend=self.spade.backend) for pk in self.pks]
+
+    def start_randomness_pool(self, size, workers=1):
+        """
+        Starts background worker processes that keep about `size` encryption randomness values precomputed.
+        """
+        from models.randomness_pool import RandomnessPool
+        self.randomness_pool = RandomnessPool(self.spade, size, workers)
+        self.randomness_pool.start()
+
+    def start_worker_pool(self, workers):
+        """
+        Starts `workers` processes (attached to the shared keys) that run the registrations and the queries
+        of the server instead of the request threads (see models.worker_pool).
+        """
+        from models.worker_pool import WorkerPool
+        self.worker_pool = WorkerPool(self, workers)
+        self.worker_pool.start()
+
+    def stop_worker_pool(self):
+        """
+        Stops the worker processes, the work runs in the calling thread again.
+        """
+        if self.worker_pool is not None:
+            self.worker_pool.stop()
+            self.worker_pool = None
+
+    def get_encryption_randomness(self, count, generate=True):
+        """
+        Returns `count` encryption randomness values from the pool, None if there is no pool
+        (the encryption then draws its own). Without `generate` None is returned too when the pool
+        runs empty, instead of generating the rest in the calling thread (e.g. for a worker process).
+        """
+        if self.randomness_pool is None:
+            return None
+        return self.randomness_pool.take(count, generate)
+
     def get_public_params(self):
         """
         Returns the public parameters (q, g) and the public keys (mpk) as bytes.
@@ -51,6 +190,42 @@ class Curator:
         """
         return self.reg_keys[user_id]
 
+    def store_kd_base(self, user_id, reg_key, kd_base=None):
+        """
+        Precomputes and stores the key derivation base of the user (done once at registration).
+        `kd_base` is the already computed base (e.g. by a bulk registration worker).
+        """
+        if kd_base is None:
+            kd_base = self.spade.key_derivation_base(self.sks, reg_key)
+        self.store_kd_bases({user_id: kd_base})
+
+    def store_kd_bases(self, kd_bases):
+        """
+        Stores the computed key derivation bases ({user_id: base}) and adds them to the keystore file
+        if there is one, so they are kept when the server stops or crashes.
+        """
+        self.kd_bases.update(kd_bases)
+        if self.shared_kd_bases is not None:
+            # A shared copy of an earlier base of the user is out of date
+            for user_id in kd_bases:
+                self.shared_kd_bases.discard(user_id)
+        if self.keystore_path and kd_bases:
+            with self._keystore_lock:
+                Keystore.append_kd_bases(self.keystore_path, kd_bases)
+
+    def get_kd_base(self, user_id):
+        """
+        Retrieves the key derivation base of the user, None if it has not been computed.
+        """
+        kd_base = self.kd_bases.get(user_id)
+        if kd_base is None and self.shared_kd_bases is not None:
+            kd_base = self.shared_kd_bases.get(user_id)
+        if kd_base is None and self.keystore is not None:
+            kd_base = self.keystore.kd_base(user_id)
+            if kd_base is not None:
+                self.kd_bases[user_id] = kd_base
+        return kd_base
+
     def store_encrypted_data(self, user_id, ciphertext):
         """
         Stores encrypted user data (ciphertext).
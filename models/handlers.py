@@ -1,6 +1,10 @@
 import sqlite3
 import json
-from typing import List, Tuple, Optional
+import struct
+import threading
+from typing import List, Tuple, Optional, Union
+import config
+from ciphertext import CiphertextVector, CT_LIMB_SIZE
 
 # Use Python's built-in `int` type for handling large integers.
 
@@ -35,15 +39,93 @@ class PBHandler:
         return dkv, cts, None
 
 
+# Binary ciphertext rows (version 3): a header followed by the ciphertext values as
+# fixed-width big-endian limbs, element after element ([c0, c1] or [c0, c1, c0_inv])
+CT_MAGIC = b"SPDC"
+CT_VERSION = 3
+CT_HEADER = struct.Struct(">4sBBBI")  # magic, version, values per element, limb size, element count
+
+# Pooled connections: the idle connections of every database, checked out by a DBHandler on
+# first use and returned by its close_connection(), whatever thread the handler runs in (the
+# server starts a new thread per request). `_open` holds every open pooled connection.
+_idle = {}
+_open = []
+_pool_lock = threading.Lock()
+
+def _checkout_connection(db_name: str):
+    """An idle pooled connection to `db_name`, or a new one."""
+    with _pool_lock:
+        idle = _idle.get(db_name)
+        if idle:
+            return idle.pop()
+    conn = _open_connection(db_name)
+    with _pool_lock:
+        _open.append((db_name, conn))
+    return conn
+
+def _checkin_connection(db_name: str, conn) -> None:
+    """Return a checked out connection, closed if there are already config.DB_POOL_SIZE idle ones."""
+    with _pool_lock:
+        if not any(c is conn for _, c in _open):
+            return  # Closed by close_pooled_connections in the meantime
+        if conn.in_transaction:
+            conn.rollback()
+        idle = _idle.setdefault(db_name, [])
+        if len(idle) < config.DB_POOL_SIZE:
+            idle.append(conn)
+            return
+        _open[:] = [(name, c) for name, c in _open if c is not conn]
+    conn.close()
+
+def _open_connection(db_name: str):
+    """Open a connection and apply config.DB_PRAGMAS (once per connection, pooled ones keep them)."""
+    # A connection is used by one handler at a time, but the handlers of the pool run in any thread
+    conn = sqlite3.connect(db_name, check_same_thread=False)
+    for pragma, value in config.DB_PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    return conn
+
+def close_pooled_connections(db_name: Optional[str] = None) -> None:
+    """Close the pooled connections (of every database, or only of `db_name`), e.g. before removing the file."""
+    with _pool_lock:
+        closing = [(name, conn) for name, conn in _open if db_name is None or name == db_name]
+        _open[:] = [(name, conn) for name, conn in _open if not (db_name is None or name == db_name)]
+        for name in [name for name in _idle if db_name is None or name == db_name]:
+            del _idle[name]
+    for _, conn in closing:
+        conn.close()
+
+def pooled_connection_count() -> int:
+    """Number of open pooled connections (idle or checked out)."""
+    with _pool_lock:
+        return len(_open)
+
+
 class DBHandler:
-    def __init__(self, db_name: str, table_name: str):
+    def __init__(self, db_name: str, table_name: str, ciphertext_format: Optional[str] = None, pooled: Optional[bool] = None):
+        """
+        `ciphertext_format` is the format of new rows, "binary" or "json" (default config.CIPHERTEXT_FORMAT).
+        A `pooled` handler (default config.DB_POOLED) checks out a pooled connection on first use and
+        close_connection() returns it, so the file open, the pragmas and the sqlite3 statement cache
+        (keyed on the SQL text, which is built once here) carry over between requests.
+        """
         self.db_name = db_name
         self.table_name = table_name
-        self.conn = self._create_connection()
+        self.ciphertext_format = ciphertext_format or config.CIPHERTEXT_FORMAT
+        self.pooled = config.DB_POOLED if pooled is None else pooled
+        self._insert_query = f"INSERT INTO {table_name} (id, reg_key, ciphertext) VALUES (?, ?, ?)"
+        self._select_query = f"SELECT reg_key, ciphertext FROM {table_name} WHERE id = ?"
+        self._conn = None if self.pooled else self._create_connection()
+
+    @property
+    def conn(self):
+        if self._conn is None and self.pooled:
+            self._conn = _checkout_connection(self.db_name)
+        return self._conn
 
     def _create_connection(self):
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = _open_connection(self.db_name)
             return conn
         except sqlite3.Error as e:
             print(f"Database connection error: {e}")
@@ -68,57 +150,223 @@ class DBHandler:
     def insert_users_cipher(self, data) -> None:
         """Insert user request data into the database."""
         ctx = self._serialize_ciphertext(data['ciphertext'])
-        query = f"INSERT INTO {self.table_name} (id, reg_key, ciphertext) VALUES (?, ?, ?)"
+        conn = self.conn
         try:
-            with self.conn:
-                self.conn.execute(query, (data['id'], data['regKey'], ctx))
+            with conn:
+                conn.execute(self._insert_query, (data['id'], data['regKey'], ctx))
         except sqlite3.Error as e:
             print(f"Error inserting data: {e}")
             raise
 
-    def get_user_req_by_id(self, user_id: int):
-        """Retrieve user request data from the database by ID."""
-        query = f"SELECT reg_key, ciphertext FROM {self.table_name} WHERE id = ?"
+    def insert_many(self, rows) -> List[bool]:
+        """
+        Insert many users (dicts like in insert_users_cipher) with one executemany in one transaction.
+        Rows whose id is already in the table (or earlier in `rows`) are skipped instead of failing
+        the whole batch. Returns for every row whether it was inserted.
+        """
+        conn = self.conn
         try:
-            with self.conn:
-                cursor = self.conn.execute(query, (user_id,))
+            with conn:
+                # Take the write lock before checking the ids, so that they can't be inserted in between
+                conn.execute("BEGIN IMMEDIATE")
+                existing = set()
+                ids = [data['id'] for data in rows]
+                for i in range(0, len(ids), 900):  # Stay below SQLite's limit of bound parameters
+                    chunk = ids[i:i + 900]
+                    placeholders = ", ".join("?" * len(chunk))
+                    existing.update(row[0] for row in conn.execute(f"SELECT id FROM {self.table_name} WHERE id IN ({placeholders})", chunk))
+
+                inserted = []
+                params = []
+                for data in rows:
+                    if data['id'] in existing:
+                        inserted.append(False)
+                        continue
+                    existing.add(data['id'])
+                    params.append((data['id'], data['regKey'], self._serialize_ciphertext(data['ciphertext'])))
+                    inserted.append(True)
+                conn.executemany(self._insert_query, params)
+            return inserted
+        except sqlite3.Error as e:
+            print(f"Error inserting data: {e}")
+            raise
+
+    def get_user_req_by_id(self, user_id: int, as_ints: bool = False, as_vector: bool = False):
+        """
+        Retrieve user request data from the database by ID. The ciphertext values are bytes,
+        ints if `as_ints`, or the ciphertext is a CiphertextVector if `as_vector`.
+        """
+        conn = self.conn
+        try:
+            with conn:
+                cursor = conn.execute(self._select_query, (user_id,))
                 row = cursor.fetchone()
                 if not row:
                     return None
 
                 reg_key = row[0]
-                ciphertext = self._deserialize_ciphertext(row[1])
+                if as_vector:
+                    ciphertext = self._deserialize_ciphertext_vector(row[1])
+                else:
+                    ciphertext = self._deserialize_ciphertext(row[1], as_ints)
                 return {"id": user_id, "reg_key": reg_key, "ciphertext": ciphertext}
         except sqlite3.Error as e:
             print(f"Error retrieving data: {e}")
             raise
 
-    def _serialize_ciphertext(self, ciphertext: List[List[bytes]]) -> bytes:
-        """Serialize the ciphertext for storage."""
+    def iter_user_reqs(self, user_ids: Optional[List[int]] = None, first_id: Optional[int] = None,
+                       last_id: Optional[int] = None, batch_size: int = config.QueryBatchSize):
+        """
+        Stream the data of many users (the ids in `user_ids`, the ids from `first_id` to `last_id`,
+        or all users) in id order, as dicts like get_user_req_by_id(as_vector=True).
+        One SELECT is read `batch_size` rows at a time, so the whole result is never in memory at once.
+        """
+        if user_ids is not None:
+            # Stay below SQLite's limit of bound parameters
+            ids = sorted(set(user_ids))
+            chunks = [ids[i:i + 900] for i in range(0, len(ids), 900)]
+            queries = [(f"WHERE id IN ({', '.join('?' * len(chunk))})", chunk) for chunk in chunks]
+        else:
+            conditions, params = [], []
+            if first_id is not None:
+                conditions.append("id >= ?")
+                params.append(first_id)
+            if last_id is not None:
+                conditions.append("id <= ?")
+                params.append(last_id)
+            queries = [(f"WHERE {' AND '.join(conditions)}" if conditions else "", params)]
+
+        conn = self.conn
+        try:
+            for where, params in queries:
+                cursor = conn.execute(f"SELECT id, reg_key, ciphertext FROM {self.table_name} {where} ORDER BY id", params)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for user_id, reg_key, serialized in rows:
+                        yield {"id": user_id, "reg_key": reg_key, "ciphertext": self._deserialize_ciphertext_vector(serialized)}
+        except sqlite3.Error as e:
+            print(f"Error retrieving data: {e}")
+            raise
+
+    def migrate_ciphertexts(self) -> int:
+        """Rewrite the rows that are not in the configured ciphertext format, returns the number of rewritten rows."""
+        rows = self.conn.execute(f"SELECT id, ciphertext FROM {self.table_name}").fetchall()
+        updates = []
+        for user_id, serialized in rows:
+            if self._is_binary(serialized) != (self.ciphertext_format == "binary"):
+                updates.append((self._serialize_ciphertext(self._deserialize_ciphertext(serialized, True)), user_id))
+        try:
+            with self.conn:
+                self.conn.executemany(f"UPDATE {self.table_name} SET ciphertext = ? WHERE id = ?", updates)
+        except sqlite3.Error as e:
+            print(f"Error migrating data: {e}")
+            raise
+        return len(updates)
+
+    @staticmethod
+    def _is_binary(serialized: bytes) -> bool:
+        return serialized[:len(CT_MAGIC)] == CT_MAGIC
+
+    def _serialize_ciphertext(self, ciphertext: Union[CiphertextVector, List[List[Union[bytes, int]]]]) -> bytes:
+        """Serialize the ciphertext (a CiphertextVector, or elements of bytes or ints) for storage."""
+        if isinstance(ciphertext, CiphertextVector):
+            if self.ciphertext_format == "binary":
+                # The vector buffer already has the row layout
+                header = CT_HEADER.pack(CT_MAGIC, CT_VERSION, ciphertext.width, ciphertext.limb_size, len(ciphertext))
+                return b''.join((header, ciphertext.buffer))
+            ciphertext = ciphertext.to_list()
+
+        width = len(ciphertext[0]) if ciphertext else 2
+        if self.ciphertext_format == "binary":
+            parts = [CT_HEADER.pack(CT_MAGIC, CT_VERSION, width, CT_LIMB_SIZE, len(ciphertext))]
+            for ct_pair in ciphertext:
+                for ct in ct_pair:
+                    if isinstance(ct, int):
+                        parts.append(ct.to_bytes(CT_LIMB_SIZE, byteorder='big'))
+                    else:
+                        parts.append(ct.rjust(CT_LIMB_SIZE, b'\x00'))
+            return b''.join(parts)
+
         # Flatten the ciphertext list and convert each byte element to hex
         flattened_hex = []
-        for ct_pair in ciphertext:  # Each ct_pair is a list like [c0, c1]
-            for ct in ct_pair:  # ct is a byte object (either c0 or c1)
+        for ct_pair in ciphertext:  # Each ct_pair is a list like [c0, c1] or [c0, c1, c0_inv]
+            for ct in ct_pair:  # ct is a byte object (c0, c1 or c0_inv)
+                if isinstance(ct, int):
+                    ct = ct.to_bytes((ct.bit_length() + 7) // 8, byteorder='big')
                 flattened_hex.append(ct.hex())  # Convert each byte object to a hex string
-    
-        # Convert the flattened list of hex strings to a JSON-encoded byte string
-        return json.dumps(flattened_hex).encode()
 
-    def _deserialize_ciphertext(self, serialized: bytes) -> List[List[bytes]]:
-        """Deserialize the stored ciphertext into pairs of [c0, c1]."""
+        if width == 2:
+            # Version 1: plain JSON list of hex strings
+            return json.dumps(flattened_hex).encode()
+
+        # Version 2: the elements carry c0^-1, so the width has to be stored with the data
+        return json.dumps({"version": 2, "width": width, "ciphertext": flattened_hex}).encode()
+
+    def _deserialize_ciphertext_vector(self, serialized: bytes) -> CiphertextVector:
+        """
+        Deserialize the stored ciphertext into a CiphertextVector. For binary rows the vector
+        is a view on the row itself: nothing is copied or decoded until values are used.
+        """
+        if self._is_binary(serialized):
+            _, version, width, limb_size, count = CT_HEADER.unpack_from(serialized)
+            if version != CT_VERSION:
+                raise ValueError(f"Unknown ciphertext version: {version}")
+            return CiphertextVector(serialized, width, limb_size, CT_HEADER.size, count)
+        return CiphertextVector.from_elements(self._deserialize_ciphertext(serialized, as_ints=True))
+
+    def _deserialize_ciphertext(self, serialized: bytes, as_ints: bool = False) -> List[List[Union[bytes, int]]]:
+        """
+        Deserialize the stored ciphertext (any version) into (c0, c1) pairs
+        (or (c0, c1, c0_inv) triples). The values are bytes, or ints if `as_ints`.
+        """
+        if self._is_binary(serialized):
+            _, version, width, limb_size, count = CT_HEADER.unpack_from(serialized)
+            if version != CT_VERSION:
+                raise ValueError(f"Unknown ciphertext version: {version}")
+            start = CT_HEADER.size
+            end = start + count * width * limb_size
+            if as_ints:
+                values = [int.from_bytes(serialized[i:i + limb_size], byteorder='big') for i in range(start, end, limb_size)]
+            else:
+                values = [serialized[i:i + limb_size] for i in range(start, end, limb_size)]
+            # Group the values of each element (as tuples, cheaper to build than lists)
+            return list(zip(*(values[k::width] for k in range(width))))
+
         # Decode the JSON-encoded serialized data into a list of hex strings
-        flattened_hex = json.loads(serialized.decode())
+        loaded = json.loads(serialized.decode())
+        if isinstance(loaded, dict):
+            width = loaded["width"]
+            flattened_hex = loaded["ciphertext"]
+        else:
+            width = 2
+            flattened_hex = loaded
     
-        # Rebuild the ciphertext list as pairs of [c0, c1] bytes
+        # Rebuild the ciphertext list as (c0, c1) (or (c0, c1, c0_inv)) entries
         ciphertext = []
-        for i in range(0, len(flattened_hex), 2):  # Step by 2, because each ciphertext entry is a pair
-            c0 = bytes.fromhex(flattened_hex[i])  # Convert the first element in the pair to bytes
-            c1 = bytes.fromhex(flattened_hex[i + 1])  # Convert the second element in the pair to bytes
-            ciphertext.append([c0, c1])  # Append the pair as a list [c0, c1]
+        for i in range(0, len(flattened_hex), width):  # Step by the width of one ciphertext entry
+            if as_ints:
+                ciphertext.append(tuple(int(h, 16) for h in flattened_hex[i:i + width]))
+            else:
+                ciphertext.append(tuple(bytes.fromhex(h) for h in flattened_hex[i:i + width]))
     
         return ciphertext
 
 
     def close_connection(self) -> None:
-        if self.conn:
-            self.conn.close()
+        """Close the connection, a pooled one is returned to the pool (see close_pooled_connections)."""
+        if self._conn:
+            if self.pooled:
+                _checkin_connection(self.db_name, self._conn)
+            else:
+                self._conn.close()
+            self._conn = None
+
+    def __del__(self):
+        # Handlers left without close_connection() (e.g. on an error response) return their connection
+        if self.pooled and self._conn is not None:
+            try:
+                self.close_connection()
+            except Exception:
+                pass
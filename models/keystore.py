@@ -0,0 +1,299 @@
+import io
+import mmap
+import os
+import struct
+import threading
+from fixed_base import FixedBaseTable
+
+# Binary curator keystore: a header, q and g, the secret and public keys, the optional
+# fixed-base tables of the public keys and the key derivation bases of the users, all as
+# fixed-width big-endian limbs like the binary ciphertext rows.
+KS_MAGIC = b"SPDK"
+KS_VERSION = 1
+KS_HEADER = struct.Struct(">4sBBIIBI")  # magic, version, limb size, n, users, table window, table rows
+KS_USER_ID = struct.Struct(">q")
+KS_USERS = struct.Struct(">I")
+KS_USERS_OFFSET = struct.calcsize(">4sBBI")  # Offset of the user count in the header
+
+KD_BLOCK_SIZE = 4 << 20  # Size of a shared memory block of key derivation bases (see SharedKdBases)
+
+def _records_offset(limb_size, n, window, table_rows):
+    """Offset of the first key derivation base record, after the keys and the tables."""
+    tables = n * table_rows * (1 << window) if window else 0
+    return KS_HEADER.size + (2 + 2 * n + tables) * limb_size
+
+class MappedRow:
+    """A fixed-base table row read from the memory map, entries are decoded when used."""
+    __slots__ = ("buffer", "offset", "limb_size", "mpz")
+
+    def __init__(self, buffer, offset, limb_size, mpz):
+        self.buffer = buffer
+        self.offset = offset
+        self.limb_size = limb_size
+        self.mpz = mpz
+
+    def __getitem__(self, d):
+        start = self.offset + d * self.limb_size
+        return self.mpz(int.from_bytes(self.buffer[start:start + self.limb_size], byteorder='big'))
+
+class MappedInts:
+    """A vector of ints read from the buffer, the values are decoded when used."""
+    __slots__ = ("buffer", "offset", "count", "limb_size")
+
+    def __init__(self, buffer, offset, count, limb_size):
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+        self.limb_size = limb_size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("key index out of range")
+        start = self.offset + index * self.limb_size
+        return int.from_bytes(self.buffer[start:start + self.limb_size], byteorder='big')
+
+    def __iter__(self):
+        size = self.limb_size
+        buffer = self.buffer
+        for start in range(self.offset, self.offset + self.count * size, size):
+            yield int.from_bytes(buffer[start:start + size], byteorder='big')
+
+class Keystore:
+    def __init__(self, path, shared=False):
+        """
+        Memory-mapped keystore file (see Keystore.save). The keys are decoded at once, the tables
+        and the key derivation bases only when they are used.
+        With `shared`, `path` is the name of a shared memory block (see Keystore.share) that is
+        attached read-only, and the keys are decoded when used too.
+        """
+        self.path = path
+        self._shm = None
+        if shared:
+            from multiprocessing import shared_memory
+            self._shm = shared_memory.SharedMemory(path)
+            self._map = self._shm.buf.toreadonly()
+        else:
+            with open(path, "rb") as file:
+                self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = self._map
+        magic, version, self.limb_size, self.n, users, self.window, self.table_rows = KS_HEADER.unpack_from(buffer)
+        if magic != KS_MAGIC or version != KS_VERSION:
+            raise ValueError(f"Not a keystore file (version {KS_VERSION}): {path}")
+
+        size = self.limb_size
+        offset = KS_HEADER.size
+        self.q, self.g = self._ints(offset, 2)
+        offset += 2 * size
+        if shared:
+            self.sks = MappedInts(buffer, offset, self.n, size)
+            self.pks = MappedInts(buffer, offset + self.n * size, self.n, size)
+        else:
+            self.sks = self._ints(offset, self.n)
+            self.pks = self._ints(offset + self.n * size, self.n)
+        offset += 2 * self.n * size
+
+        self._tables_offset = offset
+        offset = _records_offset(size, self.n, self.window, self.table_rows)
+        self._tables_end = offset
+
+        # user_id -> offset of the user's key derivation base
+        self.kd_base_offsets = {}
+        for _ in range(users):
+            (user_id,) = KS_USER_ID.unpack_from(buffer, offset)
+            self.kd_base_offsets[user_id] = offset + KS_USER_ID.size
+            offset += KS_USER_ID.size + self.n * size
+
+    def _ints(self, offset, count):
+        size = self.limb_size
+        buffer = self._map
+        return [int.from_bytes(buffer[i:i + size], byteorder='big') for i in range(offset, offset + count * size, size)]
+
+    def pk_tables(self, backend):
+        """The stored fixed-base tables of the public keys, reading their entries from the map (None if not stored)."""
+        if not self.window:
+            return None
+        size = self.limb_size
+        row_size = (1 << self.window) * size
+        tables = []
+        for k, pk in enumerate(self.pks):
+            start = self._tables_offset + k * self.table_rows * row_size
+            rows = [MappedRow(self._map, start + j * row_size, size, backend.mpz) for j in range(self.table_rows)]
+            tables.append(FixedBaseTable(pk, self.q, self.window, backend=backend, rows=rows))
+        return tables
+
+    def kd_base(self, user_id):
+        """The stored key derivation base of the user, None if it is not stored."""
+        offset = self.kd_base_offsets.get(user_id)
+        if offset is None:
+            return None
+        return self._ints(offset, self.n)
+
+    def close(self):
+        if self._shm is not None:
+            # The read-only view must be released before the block can be closed
+            self._map.release()
+            self._shm.close()
+        else:
+            self._map.close()
+
+    @staticmethod
+    def save(path, q, g, sks, pks, kd_bases, pk_tables=None, keystore=None):
+        """
+        Write the keystore file: the keys, the `pk_tables` if given and the `kd_bases` ({user_id: base},
+        plus the bases of `keystore` that aren't in it). The file is replaced atomically and only
+        the owner can read it, it holds the secret keys.
+        """
+        kd_bases = dict(kd_bases)
+        stored = [user_id for user_id in keystore.kd_base_offsets if user_id not in kd_bases] if keystore else []
+        tmp_path = f"{path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as file:
+            Keystore._write(file, q, g, sks, pks, kd_bases, pk_tables, keystore, stored)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def append_kd_bases(path, kd_bases):
+        """
+        Add the `kd_bases` ({user_id: base}) to the keystore file in place, so a registration is saved
+        at once. The records are written and synced before the user count of the header, a crash in
+        between leaves the file as it was. A later record of a user replaces the earlier one when loading.
+        """
+        with open(path, "r+b") as file:
+            magic, version, size, n, users, window, table_rows = KS_HEADER.unpack(file.read(KS_HEADER.size))
+            if magic != KS_MAGIC or version != KS_VERSION:
+                raise ValueError(f"Not a keystore file (version {KS_VERSION}): {path}")
+            # Records past the user count are left over from an interrupted append, overwrite them
+            file.seek(_records_offset(size, n, window, table_rows) + users * (KS_USER_ID.size + n * size))
+            for user_id, kd_base in kd_bases.items():
+                file.write(KS_USER_ID.pack(user_id))
+                file.write(b''.join(int(v).to_bytes(size, byteorder='big') for v in kd_base))
+            file.truncate()
+            file.flush()
+            os.fsync(file.fileno())
+            file.seek(KS_USERS_OFFSET)
+            file.write(KS_USERS.pack(users + len(kd_bases)))
+            file.flush()
+            os.fsync(file.fileno())
+
+    @staticmethod
+    def share(q, g, sks, pks, pk_tables=None, keystore=None):
+        """
+        Put the keys and the `pk_tables` in a new shared memory block, in the keystore format
+        without key derivation bases, for worker processes to attach to with Keystore(name, shared=True).
+        Returns the SharedMemory, the caller closes and unlinks it.
+        """
+        from multiprocessing import shared_memory
+        data = io.BytesIO()
+        Keystore._write(data, q, g, sks, pks, {}, pk_tables, keystore)
+        size = data.tell()
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        shm.buf[:size] = data.getbuffer()
+        return shm
+
+    @staticmethod
+    def _write(file, q, g, sks, pks, kd_bases, pk_tables=None, keystore=None, stored=()):
+        """Write the keystore format to `file`, `stored` are user ids whose bases are copied from `keystore`."""
+        size = (q.bit_length() + 7) // 8
+        n = len(sks)
+        window = pk_tables[0].window if pk_tables else 0
+        table_rows = pk_tables[0].num_rows if pk_tables else 0
+        file.write(KS_HEADER.pack(KS_MAGIC, KS_VERSION, size, n, len(kd_bases) + len(stored), window, table_rows))
+        file.write(b''.join(int(v).to_bytes(size, byteorder='big') for v in [q, g] + list(sks) + list(pks)))
+        if pk_tables:
+            if keystore and keystore.window == window and all(isinstance(table.rows[0], MappedRow) for table in pk_tables):
+                # The tables come from the old keystore, copy them as they are
+                file.write(keystore._map[keystore._tables_offset:keystore._tables_end])
+            else:
+                for table in pk_tables:
+                    for row in table.rows:
+                        file.write(b''.join(int(row[d]).to_bytes(size, byteorder='big') for d in range(1 << window)))
+        for user_id, kd_base in kd_bases.items():
+            file.write(KS_USER_ID.pack(user_id))
+            file.write(b''.join(int(v).to_bytes(size, byteorder='big') for v in kd_base))
+        for user_id in stored:
+            offset = keystore.kd_base_offsets[user_id]
+            file.write(KS_USER_ID.pack(user_id))
+            file.write(keystore._map[offset:offset + n * size])
+
+def _read_ints(buffer, offset, count, size):
+    return [int.from_bytes(buffer[i:i + size], byteorder='big') for i in range(offset, offset + count * size, size)]
+
+class SharedKdBases:
+    """
+    Key derivation bases in shared memory blocks for worker processes: a task gets the location of
+    the user's base (see put) and the worker reads it with SharedKdBases.read, instead of a pickled
+    copy of the base. Only the curator's process writes, a stored base is never overwritten.
+    """
+    _attached = {}  # Blocks attached by a worker process, by name
+
+    def __init__(self, n, limb_size):
+        self.n = n
+        self.limb_size = limb_size
+        self.users_per_block = max(1, KD_BLOCK_SIZE // (n * limb_size))
+        self._blocks = []
+        self._locations = {}
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def location(self, user_id):
+        """The location of the user's stored base, None if it is not stored."""
+        return self._locations.get(user_id)
+
+    def user_ids(self):
+        """The ids of the users whose bases are stored."""
+        return list(self._locations)
+
+    def get(self, user_id):
+        """The user's stored base, read from the block in the curator's process, None if it is not stored."""
+        location = self._locations.get(user_id)
+        if location is None:
+            return None
+        name, offset, count, size = location
+        buffer = next(shm for shm in self._blocks if shm.name == name).buf
+        return _read_ints(buffer, offset, count, size)
+
+    def discard(self, user_id):
+        """Forget the user's stored base (its slot isn't reused)."""
+        self._locations.pop(user_id, None)
+
+    def put(self, user_id, kd_base):
+        """Copy the base to a free slot (a new block when the last one is full) and return its location."""
+        record_size = self.n * self.limb_size
+        with self._lock:
+            block, slot = divmod(self._used, self.users_per_block)
+            if block == len(self._blocks):
+                from multiprocessing import shared_memory
+                self._blocks.append(shared_memory.SharedMemory(create=True, size=self.users_per_block * record_size))
+            self._used += 1
+        shm = self._blocks[block]
+        offset = slot * record_size
+        shm.buf[offset:offset + record_size] = b''.join(int(v).to_bytes(self.limb_size, byteorder='big') for v in kd_base)
+        location = (shm.name, offset, self.n, self.limb_size)
+        # Published only when the base is written
+        self._locations[user_id] = location
+        return location
+
+    @classmethod
+    def read(cls, location):
+        """The base at `location` (see put), in a worker process. The block is attached on the first read."""
+        name, offset, count, size = location
+        shm = cls._attached.get(name)
+        if shm is None:
+            from multiprocessing import shared_memory
+            shm = cls._attached[name] = shared_memory.SharedMemory(name)
+        return _read_ints(shm.buf, offset, count, size)
+
+    def close(self):
+        """Remove the blocks (the workers reading them must be stopped first)."""
+        for shm in self._blocks:
+            shm.close()
+            shm.unlink()
+        self._blocks = []
+        self._locations = {}
@@ -0,0 +1,178 @@
+import os
+import time
+import stats
+from spade import SPADE
+from models.keystore import Keystore, SharedKdBases
+from config import QUERY_WORKERS
+
+def decrypt_user(spade, sks, user_req, query_value, kd_base=None, matches=False):
+    """
+    Derive the decryption keys of one user (a dict like DBHandler.get_user_req_by_id) and decrypt the user's data.
+    With `matches` only whether each position matches the query value is returned (see SPADE.decrypt_columns).
+    """
+    reg_key = int.from_bytes(user_req['reg_key'], byteorder='big')
+    dk = spade.key_derivation(user_req['id'], query_value, sks, reg_key, kd_base)
+    return spade.decrypt_columns(dk, query_value, spade.decode(user_req['ciphertext']), matches)
+
+def _timed_decrypt_user(spade, sks, user_req, query_value, kd_base=None, matches=False):
+    """
+    decrypt_user measuring the time and the memory of its steps. Returns the result and the measures
+    ({"time_of_kd", "time_of_decode", "time_of_dec", "current_kd", "peak_memory_kd", "current_dec", "peak_memory_dec"}).
+    """
+    import tracemalloc
+
+    # Derive decryption keys using the query value and the registration key
+    reg_key = int.from_bytes(user_req['reg_key'], byteorder='big')
+    tracemalloc.start()
+    start_time = time.time()
+    dk = spade.key_derivation(user_req['id'], query_value, sks, reg_key, kd_base)
+    time_of_kd = time.time() - start_time
+    current_kd, peak_memory_kd = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # The ciphertext is a CiphertextVector on the database row, decode its values
+    start_time = time.time()
+    columns = spade.decode(user_req['ciphertext'])
+    time_of_decode = time.time() - start_time
+
+    # Decrypt the ciphertext using the derived keys
+    tracemalloc.start()
+    start_time = time.time()
+    decrypted = spade.decrypt_columns(dk, query_value, columns, matches)
+    time_of_dec = time.time() - start_time
+    current_dec, peak_memory_dec = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return decrypted, {
+        "time_of_kd": time_of_kd,
+        "time_of_decode": time_of_decode,
+        "time_of_dec": time_of_dec,
+        "current_kd": current_kd,
+        "peak_memory_kd": peak_memory_kd,
+        "current_dec": current_dec,
+        "peak_memory_dec": peak_memory_dec
+    }
+
+def query_user(curator, user_req, query_value, matches=False):
+    """
+    Decrypt one user like decrypt_user and return the result with the measures of _timed_decrypt_user.
+    It runs in a worker process of the server when the curator has a worker pool (see Curator.start_worker_pool).
+    """
+    if curator.worker_pool is not None:
+        # The worker reads the key derivation base from shared memory
+        return curator.worker_pool.apply(_query_user_task, (user_req, query_value, curator.share_kd_base(user_req['id']), matches))
+    kd_base = curator.get_kd_base(user_req['id'])
+    return _timed_decrypt_user(curator.spade, curator.sks, user_req, query_value, kd_base, matches)
+
+def query_user_values(curator, user_req, values):
+    """
+    SPADE.decrypt_values of one user for all `values`, in a worker process of the server like query_user.
+    """
+    if curator.worker_pool is not None:
+        return curator.worker_pool.apply(_query_values_task, (user_req, values, curator.share_kd_base(user_req['id'])))
+    kd_base = curator.get_kd_base(user_req['id'])
+    reg_key = int.from_bytes(user_req['reg_key'], byteorder='big')
+    return curator.spade.decrypt_values(values, curator.sks, reg_key, user_req['ciphertext'], kd_base)
+
+# State of a query worker process, set by _init_query_worker
+_query_worker = None
+_query_keystore = None
+
+def _query_worker_params(spade, curator):
+    """Initializer parameters of the query workers for `spade` and the curator's shared keys."""
+    return (spade.q, spade.g, spade.n, spade.g_table.window, spade.backend.name, curator.share_keys())
+
+def _init_query_worker(params):
+    global _query_worker, _query_keystore
+    q, g, n, window, backend, shared_keys = params
+    # The keys are read from the curator's shared memory, not copied
+    _query_keystore = Keystore(shared_keys, shared=True)
+    _query_worker = (SPADE(q, g, n, window, backend), _query_keystore.sks)
+
+def _worker_kd_base(location):
+    """The key derivation base at `location` in the curator's shared memory (see Curator.share_kd_base)."""
+    return SharedKdBases.read(location) if location is not None else None
+
+def _query_user_task(user_req, query_value, kd_base_location, matches):
+    spade, sks = _query_worker
+    return _timed_decrypt_user(spade, sks, user_req, query_value, _worker_kd_base(kd_base_location), matches)
+
+def _query_values_task(user_req, values, kd_base_location):
+    spade, sks = _query_worker
+    reg_key = int.from_bytes(user_req['reg_key'], byteorder='big')
+    return spade.decrypt_values(values, sks, reg_key, user_req['ciphertext'], _worker_kd_base(kd_base_location))
+
+def _query_task(task):
+    user_req, query_value, kd_base_location, mapper, matches = task
+    spade, sks = _query_worker
+    try:
+        kd_base = _worker_kd_base(kd_base_location)
+        decrypted = decrypt_user(spade, sks, user_req, query_value, kd_base, matches)
+        return user_req['id'], mapper(decrypted) if mapper else decrypted, None
+    except Exception as e:
+        return user_req['id'], None, str(e)
+
+def query_users(curator, user_reqs, query_value, workers=None, mapper=None, matches=False):
+    """
+    Decrypt the data of many users for one query value. `user_reqs` is an iterable of user data
+    (e.g. DBHandler.iter_user_reqs), it is consumed while the first users are being decrypted.
+    The users are decrypted in `workers` processes (default config.QUERY_WORKERS, 0 = one per CPU).
+    `mapper` (a module-level function, it is sent to the workers) is applied to each decrypted vector
+    in the worker, so that only its result comes back. With `matches` the mapper (or the result) gets booleans
+    of the matching positions instead of the decrypted values. Yields (user_id, result, error) in the order of `user_reqs`.
+    """
+    spade = curator.spade
+    # The worker tasks get the location of the key derivation base in shared memory instead of the base
+    tasks = ((user_req, query_value, curator.share_kd_base(user_req['id']), mapper, matches) for user_req in user_reqs)
+
+    if curator.worker_pool is not None:
+        # The server's worker processes (see Curator.start_worker_pool)
+        yield from curator.worker_pool.imap(_query_task, tasks, chunksize=4)
+        return
+
+    workers = workers or QUERY_WORKERS or os.cpu_count() or 1
+    if workers == 1:
+        for user_req in user_reqs:
+            try:
+                kd_base = curator.get_kd_base(user_req['id'])
+                decrypted = decrypt_user(spade, curator.sks, user_req, query_value, kd_base, matches)
+                yield user_req['id'], mapper(decrypted) if mapper else decrypted, None
+            except Exception as e:
+                yield user_req['id'], None, str(e)
+        return
+
+    import multiprocessing
+    # The workers attach to the curator's shared keys for the key derivation, like the bulk registration workers
+    params = _query_worker_params(spade, curator)
+    with multiprocessing.Pool(workers, _init_query_worker, (params,)) as pool:
+        # The pool's task thread reads `user_reqs`, so rows are fetched while the workers decrypt
+        yield from pool.imap(_query_task, tasks, chunksize=4)
+
+def aggregate_users(curator, user_reqs, query_value, workers=None):
+    """
+    Population aggregates of one query value over many users (see query_users), reduced here from the
+    per-user statistics computed by the workers (stats.value_stats): the total count, the histogram of
+    the per-user counts ({count: number of users}) and the mean length of the runs (sequences) of the value.
+    """
+    users = 0
+    total_count = 0
+    total_runs = 0
+    histogram = {}
+    errors = []
+    for user_id, result, error in query_users(curator, user_reqs, query_value, workers, stats.value_stats, matches=True):
+        if error is not None:
+            errors.append({"user_id": user_id, "message": error})
+            continue
+        count, runs = result["count"], result["sequences"]
+        users += 1
+        total_count += count
+        total_runs += runs
+        histogram[count] = histogram.get(count, 0) + 1
+
+    return {
+        "users": users,
+        "total_count": total_count,
+        "histogram": dict(sorted(histogram.items())),
+        "mean_run_length": total_count / total_runs if total_runs else 0,
+        "errors": errors,
+    }
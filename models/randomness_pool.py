@@ -0,0 +1,87 @@
+import multiprocessing
+import queue
+import signal
+import threading
+from spade import SPADE
+
+def _fill(params, chunk_size, chunks, stop_event):
+    """Worker process: generate randomness chunks until stopped (blocks while the pool is full)."""
+    q, g, window, backend = params
+    # Stopped by the curator's process (see RandomnessPool.stop), not by a signal sent to the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # Buffered chunks may be dropped when the worker stops, don't wait for them to be read
+    chunks.cancel_join_thread()
+    spade = SPADE(q, g, 0, window, backend)
+    while not stop_event.is_set():
+        chunk = spade.backend.to_ints(spade.encryption_randomness(chunk_size))
+        while not stop_event.is_set():
+            try:
+                chunks.put(chunk, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
+class RandomnessPool:
+    def __init__(self, spade, size, workers=1, chunk_size=100):
+        """
+        Buffer of precomputed encryption randomness (g^r values) for `spade`.
+        Background worker processes keep about `size` values ready in chunks of `chunk_size`,
+        so that encryptions during bursts do not have to exponentiate g inside the request.
+        Processes are used instead of threads so that refilling doesn't hold the GIL of the server.
+        """
+        self.spade = spade
+        self.size = size
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._chunks = multiprocessing.Queue(max(1, size // chunk_size))
+        self._stop_event = multiprocessing.Event()
+        self._leftover = []  # Unused part of the last chunk taken
+        self._lock = threading.Lock()
+        self._processes = []
+
+    def start(self):
+        """Start the background workers."""
+        params = (self.spade.q, self.spade.g, self.spade.g_table.window, self.spade.backend.name)
+        for i in range(self.workers):
+            process = multiprocessing.Process(target=_fill, name=f"randomness-pool-{i}",
+                                              args=(params, self.chunk_size, self._chunks, self._stop_event), daemon=True)
+            process.start()
+            self._processes.append(process)
+
+    def stop(self):
+        """Stop the background workers and wait for them to finish."""
+        self._stop_event.set()
+        for process in self._processes:
+            process.join()
+        self._processes = []
+
+    @property
+    def available(self):
+        """Approximate number of buffered randomness values."""
+        return self._chunks.qsize() * self.chunk_size + len(self._leftover)
+
+    def take(self, count, generate=True):
+        """
+        Take `count` randomness values from the pool. When the pool runs empty the
+        rest is generated inline, or with `generate` False nothing is taken and None is returned.
+        """
+        taken = []
+        with self._lock:
+            while len(taken) < count:
+                if not self._leftover:
+                    try:
+                        self._leftover = self._chunks.get_nowait()
+                    except queue.Empty:
+                        break
+                needed = count - len(taken)
+                taken.extend(self._leftover[:needed])
+                self._leftover = self._leftover[needed:]
+            if len(taken) < count and not generate:
+                # Put the values back for the next encryption
+                self._leftover = taken + self._leftover
+                return None
+
+        if len(taken) < count:
+            taken.extend(self.spade.encryption_randomness(count - len(taken)))
+        return taken
@@ -1,10 +1,10 @@
+import os
 import time
-from random import randint
 import utils  
 from spade import SPADE
-from config import DbName, TbName  # Import from config
+from config import DbName, TbName, STORE_C0_INVERSE, BULK_WORKERS  # Import from config
 from models.handlers import DBHandler, PBHandler
-import tracemalloc
+from models.keystore import Keystore
 
 # Assuming the User class remains similar, managing user state
 class User:
@@ -20,7 +20,6 @@ class User:
         return User(uid, q, g, mpk)
 
 def create_user(user_id, data, max_vec_size, curator):
-
     db_handler = DBHandler(DbName, TbName)
     pb_handler = PBHandler()
 
@@ -32,46 +31,163 @@ def create_user(user_id, data, max_vec_size, curator):
     # Initialize user
     user = User(user_id, q, g, mpk)
 
-    # Initialize SPADE
-    spade_instance = SPADE(q, g, max_vec_size)  # Pass correct parameters
+    # Use the curator's SPADE instance (its g table is already built) when the parameters match
+    if (curator.spade.q, curator.spade.g, curator.spade.n) == (q, g, max_vec_size):
+        spade_instance = curator.spade
+    else:
+        spade_instance = SPADE(q, g, max_vec_size)  # Pass correct parameters
+
+    if curator.worker_pool is not None and spade_instance is curator.spade:
+        # Register and encrypt in a worker process of the server (see Curator.start_worker_pool),
+        # which computes the key derivation base too. The worker draws the randomness itself if the pool is empty.
+        randomness = curator.get_encryption_randomness(max_vec_size, generate=False)
+        user.alpha, reg_key, enc_data, measures, kd_base = curator.worker_pool.apply(_create_user_task, (user_id, data, randomness))
+    else:
+        randomness = curator.get_encryption_randomness(max_vec_size) if spade_instance is curator.spade else None
+        user.alpha, reg_key, enc_data, measures = _register_and_encrypt(spade_instance, mpk, curator.pk_tables, user_id, data, randomness)
+        kd_base = None
+ 
+    db_handler.insert_users_cipher(enc_data)
+    db_handler.close_connection()
+
+    # Precompute the key derivation base so that queries need only one exponentiation
+    curator.store_kd_base(user.id, reg_key, kd_base)
+
+    return (user, *measures)
+
+def _register_and_encrypt(spade, pks, pk_tables, user_id, data, randomness=None):
+    """
+    Register and encrypt one user, measuring the time and the memory of both steps.
+    Returns the user's alpha and registration key, the database row and the measures
+    (time_of_reg, time_of_enc, current_reg, peak_memory_reg, current_enc, peak_memory_enc).
+    """
+    import tracemalloc
 
     tracemalloc.start()
     start_time = time.time()
     # Generate random secret for the user
-    user.alpha = randint(1, q - 1)
-    reg_key = spade_instance.register(user.alpha)
+    alpha = utils.random_element_in_zmod(spade.q)
+    reg_key = spade.register(alpha)
     time_of_reg = time.time() - start_time
     current_reg, peak_memory_reg = tracemalloc.get_traced_memory()
     tracemalloc.stop()
-    
+
     tracemalloc.start()
     start_time = time.time()
     # Encrypt user's data using "mpk" (public key)
-    ciphertext = spade_instance.encrypt(mpk, user.alpha, data)
+    ciphertext = spade.encrypt(pks, alpha, data, STORE_C0_INVERSE, reg_key, pk_tables, randomness)
     time_of_enc = time.time() - start_time
     current_enc, peak_memory_enc = tracemalloc.get_traced_memory()
     tracemalloc.stop()
 
-    # Flatten ciphertext for transmission
-    ciphertext_bytes = []
-    for c0, c1 in ciphertext:  # Each row is [c0, c1]
-        c0_bytes = c0.to_bytes((c0.bit_length() + 7) // 8, byteorder='big')
-        c1_bytes = c1.to_bytes((c1.bit_length() + 7) // 8, byteorder='big')
-        ciphertext_bytes.append((c0_bytes, c1_bytes))  # Store as tuples
-
-
     # Prepare the data to be sent (including the ciphertext and reg_key)
     enc_data = {
-        'id': user.id,
+        'id': user_id,
         'regKey': reg_key.to_bytes((reg_key.bit_length() + 7) // 8, byteorder='big'),
-        'ciphertext': ciphertext_bytes,
+        'ciphertext': ciphertext,  # DBHandler packs the ints straight into the row format
     }
- 
-    db_handler.insert_users_cipher(enc_data)
-    db_handler.close_connection()
-
-    return user, time_of_reg ,time_of_enc, current_reg, peak_memory_reg, current_enc, peak_memory_enc
-
+    return alpha, reg_key, enc_data, (time_of_reg, time_of_enc, current_reg, peak_memory_reg, current_enc, peak_memory_enc)
 
 
+def _encrypt_user(spade, pks, pk_tables, sks, user_id, data, randomness=None):
+    """Register and encrypt one user, returns the database row and the user's key derivation base."""
+    alpha = utils.random_element_in_zmod(spade.q)
+    reg_key = spade.register(alpha)
+    ciphertext = spade.encrypt(pks, alpha, data, STORE_C0_INVERSE, reg_key, pk_tables, randomness)
+    enc_data = {
+        'id': user_id,
+        'regKey': reg_key.to_bytes((reg_key.bit_length() + 7) // 8, byteorder='big'),
+        'ciphertext': ciphertext,
+    }
+    return enc_data, spade.key_derivation_base(sks, reg_key)
+
+# State of a bulk registration worker process, set by _init_bulk_worker
+_bulk_worker = None
+_bulk_keystore = None
+
+def _bulk_worker_params(spade, curator, use_pk_tables):
+    """Initializer parameters of the bulk registration workers for `spade` and the curator's shared keys."""
+    return (spade.q, spade.g, spade.n, spade.g_table.window, spade.backend.name, curator.share_keys(), use_pk_tables)
+
+def _init_bulk_worker(params):
+    global _bulk_worker, _bulk_keystore
+    q, g, n, window, backend, shared_keys, use_pk_tables = params
+    spade = SPADE(q, g, n, window, backend)
+    # The keys and the public key tables are read from the curator's shared memory, not copied
+    _bulk_keystore = Keystore(shared_keys, shared=True)
+    pk_tables = _bulk_keystore.pk_tables(spade.backend) if use_pk_tables else None
+    _bulk_worker = (spade, _bulk_keystore.pks, pk_tables, _bulk_keystore.sks)
+
+def _create_user_task(user_id, data, randomness=None):
+    """create_user in a worker: the registration and the encryption with their measures, and the key derivation base."""
+    spade, pks, pk_tables, sks = _bulk_worker
+    alpha, reg_key, enc_data, measures = _register_and_encrypt(spade, pks, pk_tables, user_id, data, randomness)
+    return alpha, reg_key, enc_data, measures, spade.key_derivation_base(sks, reg_key)
+
+def _encrypt_user_task(task):
+    user_id, data, randomness = task
+    try:
+        return user_id, _encrypt_user(*_bulk_worker, user_id, data, randomness), None
+    except Exception as e:
+        return user_id, None, str(e)
+
+def create_users(users, max_vec_size, curator, workers=None):
+    """
+    Register and encrypt many users, given as (user_id, data) pairs, and insert them all in one transaction.
+    The encryptions run in `workers` processes (default config.BULK_WORKERS, 0 = one per CPU).
+    Returns the status of every user ({"user_id", "status", "message"}), the encryption time and the insert time.
+    """
+    spade = curator.spade
+    if spade.n != max_vec_size:
+        spade = SPADE(curator.q, curator.g, max_vec_size)
+    pk_tables = curator.pk_tables if spade is curator.spade else None
+
+    workers = workers or BULK_WORKERS or os.cpu_count() or 1
+    start_time = time.time()
+    if (curator.worker_pool is not None and spade is curator.spade) or (workers > 1 and len(users) > 1):
+        # The precomputed randomness goes with the tasks, the workers draw their own when the pool runs empty
+        tasks = [(user_id, data, curator.get_encryption_randomness(spade.n, generate=False) if spade is curator.spade else None)
+                 for user_id, data in users]
+    if curator.worker_pool is not None and spade is curator.spade:
+        # The server's worker processes (see Curator.start_worker_pool), in small chunks so that
+        # the single registrations and queries of other requests get in between
+        encrypted = curator.worker_pool.map(_encrypt_user_task, tasks, chunksize=4)
+    elif workers > 1 and len(users) > 1:
+        import multiprocessing
+        # The workers attach to the secret keys too (computing the key derivation bases is as much work
+        # as the encryption), they are child processes of the curator and don't outlive the request
+        params = _bulk_worker_params(spade, curator, pk_tables is not None)
+        chunksize = max(1, len(users) // (4 * workers))
+        with multiprocessing.Pool(workers, _init_bulk_worker, (params,)) as pool:
+            encrypted = pool.map(_encrypt_user_task, tasks, chunksize)
+    else:
+        encrypted = []
+        for user_id, data in users:
+            try:
+                randomness = curator.get_encryption_randomness(spade.n) if spade is curator.spade else None
+                encrypted.append((user_id, _encrypt_user(spade, curator.pks, pk_tables, curator.sks, user_id, data, randomness), None))
+            except Exception as e:
+                encrypted.append((user_id, None, str(e)))
+    time_of_enc = time.time() - start_time
 
+    start_time = time.time()
+    rows = [result[0] for _, result, _ in encrypted if result is not None]
+    db_handler = DBHandler(DbName, TbName)
+    inserted = iter(db_handler.insert_many(rows))
+    db_handler.close_connection()
+    time_of_insert = time.time() - start_time
+
+    statuses = []
+    kd_bases = {}
+    for user_id, result, error in encrypted:
+        if result is None:
+            statuses.append({"user_id": user_id, "status": "error", "message": error})
+        elif next(inserted):
+            enc_data, kd_base = result
+            kd_bases[user_id] = kd_base
+            statuses.append({"user_id": user_id, "status": "success", "message": "User registered"})
+        else:
+            statuses.append({"user_id": user_id, "status": "error", "message": "User already exists"})
+    # Stored (and added to the keystore file) at once for the whole batch
+    curator.store_kd_bases(kd_bases)
+    return statuses, time_of_enc, time_of_insert
@@ -0,0 +1,77 @@
+import multiprocessing
+import signal
+import time
+from collections import deque
+from itertools import islice
+from models.user import _bulk_worker_params, _init_bulk_worker
+from models.query import _query_worker_params, _init_query_worker
+
+def _init_worker(bulk_params, query_params):
+    """Worker process of the server: the state of both a bulk registration and a query worker."""
+    # Only the server process handles shutdown: a worker killed by a Ctrl+C or a SIGTERM sent to the whole
+    # process group could die holding the lock of the task queue, and stop() would then wait forever
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    _init_bulk_worker(bulk_params)
+    _init_query_worker(query_params)
+
+def _run_chunk(func, chunk):
+    return [func(item) for item in chunk]
+
+class WorkerPool:
+    def __init__(self, curator, workers):
+        """
+        Persistent pool of `workers` processes for the CPU-bound work of the server (registration,
+        encryption, key derivation and decryption), so that the request threads only wait for results.
+        The workers attach to the curator's shared keys (see Curator.share_keys) once when they start.
+        """
+        self.curator = curator
+        self.workers = workers
+        self._pool = None
+
+    def start(self):
+        """Start the worker processes."""
+        spade = self.curator.spade
+        params = (_bulk_worker_params(spade, self.curator, self.curator.pk_tables is not None),
+                  _query_worker_params(spade, self.curator))
+        self._pool = multiprocessing.Pool(self.workers, _init_worker, params)
+
+    def stop(self, timeout=10):
+        """Stop the worker processes: they finish their tasks, the ones still running after `timeout` seconds are killed."""
+        if self._pool is None:
+            return
+        pool, self._pool = self._pool, None
+        processes = list(pool._pool)
+        pool.close()
+        deadline = time.monotonic() + timeout
+        for process in processes:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+                process.join()
+        # The workers are gone, this only stops the pool's handler threads
+        pool.terminate()
+
+    def apply(self, func, args=()):
+        """Run func(*args) in a worker and return its result (safe to call from many threads)."""
+        return self._pool.apply(func, args)
+
+    def map(self, func, iterable, chunksize=1):
+        return list(self.imap(func, iterable, chunksize))
+
+    def imap(self, func, iterable, chunksize=1):
+        """
+        Like Pool.imap, but only two chunks per worker are queued at a time: the next ones are submitted
+        as results come back, so the single tasks of other requests (apply) don't wait for a whole batch.
+        """
+        items = iter(iterable)
+        pending = deque()
+        while True:
+            while len(pending) < 2 * self.workers:
+                chunk = list(islice(items, chunksize))
+                if not chunk:
+                    break
+                pending.append(self._pool.apply_async(_run_chunk, (func, chunk)))
+            if not pending:
+                return
+            yield from pending.popleft().get()
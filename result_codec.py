@@ -0,0 +1,64 @@
+# result_codec.py
+# Compact encodings of a decrypted query result. Only whether a position is 1 (matches the
+# query value) is meaningful, so the result can be sent as matches instead of 128-bit integers.
+import base64
+
+ENCODINGS = ("list", "bitmap", "positions", "runs")
+
+def check_encoding(encoding):
+    """Raise ValueError if `encoding` is not one of ENCODINGS."""
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown encoding: {encoding} (use one of {', '.join(ENCODINGS)})")
+
+def encode_result(decrypted_data, encoding="bitmap"):
+    """
+    Encode the decrypted result as a JSON-ready dict {"encoding", "length", "data"}:
+    "bitmap" packs one bit per position (most significant bit first) in base64,
+    "positions" is the sorted list of matching positions, "runs" is a list of [start, length]
+    of the runs of matching positions, and "list" is the plain decrypted result.
+    """
+    check_encoding(encoding)
+    if encoding == "list":
+        data = decrypted_data
+    elif encoding == "bitmap":
+        bits = "".join("1" if value == 1 else "0" for value in decrypted_data)
+        # Pad the last byte with zeros
+        bits += "0" * (-len(bits) % 8)
+        packed = int(bits, 2).to_bytes(len(bits) // 8, byteorder='big') if bits else b''
+        data = base64.b64encode(packed).decode()
+    elif encoding == "positions":
+        data = [i for i, value in enumerate(decrypted_data) if value == 1]
+    else:
+        data = []
+        for i, value in enumerate(decrypted_data):
+            if value == 1:
+                if data and data[-1][0] + data[-1][1] == i:
+                    data[-1][1] += 1
+                else:
+                    data.append([i, 1])
+    return {"encoding": encoding, "length": len(decrypted_data), "data": data}
+
+def decode_result(encoded):
+    """
+    Decode an encoded result (see encode_result) into a list with 1 at the matching positions and
+    0 elsewhere, which gives the same statistics as the decrypted result. "list" is returned as is.
+    """
+    encoding = encoded["encoding"]
+    length = encoded["length"]
+    data = encoded["data"]
+    check_encoding(encoding)
+    if encoding == "list":
+        return data
+    if encoding == "bitmap":
+        packed = base64.b64decode(data)
+        bits = bin(int.from_bytes(packed, byteorder='big'))[2:].zfill(8 * len(packed)) if packed else ""
+        return [1 if bit == "1" else 0 for bit in bits[:length]]
+
+    result = [0] * length
+    if encoding == "positions":
+        for i in data:
+            result[i] = 1
+    else:
+        for start, run_length in data:
+            result[start:start + run_length] = [1] * run_length
+    return result
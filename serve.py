@@ -0,0 +1,48 @@
+import argparse
+import atexit
+import os
+import signal
+import sys
+import config
+import app as server
+from models.curator import Curator
+
+# Production server for the routes of app.py (instead of Flask's debug server):
+#   python serve.py [--workers N] [--threads N] [--host HOST] [--port PORT]
+# The requests are served by a pool of threads (waitress, or Werkzeug's threaded server when waitress
+# is not installed) and every encryption and decryption runs in a pool of worker processes that
+# share the curator's keys (see Curator.start_worker_pool), so a long request doesn't block the others.
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the SPADE server with worker processes.")
+    parser.add_argument("--workers", type=int, default=config.SERVER_WORKERS, help="worker processes (0 = one per CPU)")
+    parser.add_argument("--threads", type=int, default=config.SERVER_THREADS, help="request threads")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+
+    curator = Curator()
+    print(f"Setup time: {curator.setup_time}s")
+    print(f"Setup memory allecation: {curator.setup_memory / 1024:.2f} KB")
+    server.curator = curator
+
+    # The worker processes are started before the server threads
+    workers = args.workers or os.cpu_count() or 1
+    curator.start_worker_pool(workers)
+    print(f"Started {workers} worker process(es)")
+
+    # Register the cleanup function to execute at program exit, also when stopped with SIGTERM
+    atexit.register(server.cleanup)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        from waitress import serve
+    except ImportError:
+        print("waitress is not installed, using Werkzeug's threaded server")
+        from werkzeug.serving import run_simple
+        run_simple(args.host, args.port, server.app, threaded=True)
+    else:
+        serve(server.app, host=args.host, port=args.port, threads=args.threads)
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,37 @@
 # spade.py
-import random
-from sympy import mod_inverse
-from utils import gcd, random_element_in_zmod
-import tracemalloc
+import os
+from math import gcd
+from utils import random_elements_in_zmod, batch_mod_inverse
+from fixed_base import FixedBaseTable
+from backend import get_backend
+from ciphertext import CiphertextVector, ciphertext_columns
 import time
 
+# Largest chunk of public keys of a setup worker, setup uses workers only from two full chunks
+# (below that starting the processes takes longer than the keys)
+SETUP_CHUNK_SIZE = 10000
+
+# g table of a setup worker process, set by _init_setup_worker
+_setup_table = None
+
+def _init_setup_worker(params):
+    global _setup_table
+    # The worker is forked while the parent traces its memory, the tracing would slow every pow down
+    import tracemalloc
+    tracemalloc.stop()
+    q, g, window, backend = params
+    _setup_table = FixedBaseTable(g, q, window, backend=get_backend(backend))
+
+def _setup_chunk(sks):
+    """Setup worker: the public keys g^sk of one chunk of secret keys."""
+    return _setup_table.backend.to_ints([_setup_table.pow(sk) for sk in sks])
+
 class SPADE:
-    def __init__(self, modulus, generator, max_pt_vec_size):
+    def __init__(self, modulus, generator, max_pt_vec_size, window=8, backend=None):
         """
         Initialize SPADE with the modulus (q), generator (g), and the maximum plaintext vector size (n).
+        `window` is the window size of the fixed-base table used for all powers of g.
+        `backend` is the big-integer backend name or instance (see backend.get_backend).
         """
         self.n = max_pt_vec_size
         self.q = modulus
@@ -16,78 +39,245 @@ class SPADE:
         
         if gcd(self.g, self.q) != 1:
             raise ValueError("Generator and modulus are not relatively prime!")
+
+        # All arithmetic goes through the backend, values are returned as Python ints
+        self.backend = get_backend(backend)
+        self._q = self.backend.mpz(self.q)
+        self.limb_size = (self.q.bit_length() + 7) // 8
+
+        # Every g^x of setup, register and encrypt goes through this table
+        self.g_table = FixedBaseTable(self.g, self.q, window, backend=self.backend)
     
-    def setup(self):
+    def setup(self, workers=1, chunk_size=None, progress=None):
         """
         Setup generates the secret and public keys for SPADE.
+        The public keys are computed in chunks of `chunk_size` keys by `workers` processes
+        (0 = one per CPU, 1 = no worker processes) when there are at least two full chunks of
+        SETUP_CHUNK_SIZE keys, smaller sizes are computed here. The secret keys are all drawn here and the
+        chunks are merged in order, so the result doesn't depend on the number of workers.
+        `progress(done, total)` is called after every chunk. The peak memory is the one of this process.
         """
+        import tracemalloc
         tracemalloc.start()
         start_time = time.time()
-        sks = [random_element_in_zmod(self.q) for _ in range(self.n)]
-        pks = [pow(self.g, sk, self.q) for sk in sks]
+        sks = random_elements_in_zmod(self.q, self.n)
+        workers = workers or os.cpu_count() or 1
+        if self.n < 2 * SETUP_CHUNK_SIZE:
+            workers = 1
+        chunk_size = chunk_size or max(1, min(SETUP_CHUNK_SIZE, -(-self.n // (4 * workers))))
+        chunks = [sks[i:i + chunk_size] for i in range(0, self.n, chunk_size)]
+        if workers > 1 and len(chunks) > 1:
+            import multiprocessing
+            params = (self.q, self.g, self.g_table.window, self.backend.name)
+            with multiprocessing.Pool(min(workers, len(chunks)), _init_setup_worker, (params,)) as pool:
+                pk_chunks = pool.imap(_setup_chunk, chunks)
+                pks = self._merge_setup_chunks(pk_chunks, progress)
+        else:
+            pk_chunks = (self.backend.to_ints([self.g_table.pow(sk) for sk in chunk]) for chunk in chunks)
+            pks = self._merge_setup_chunks(pk_chunks, progress)
         time_taken = time.time() - start_time
         current, peak_memory = tracemalloc.get_traced_memory()
         tracemalloc.stop()
         return sks, pks, time_taken, peak_memory
+
+    def _merge_setup_chunks(self, pk_chunks, progress=None):
+        """Concatenate the public key chunks (in the order of the secret keys), reporting the progress."""
+        pks = []
+        for chunk in pk_chunks:
+            pks.extend(chunk)
+            if progress is not None:
+                progress(len(pks), self.n)
+        return pks
     
     def register(self, alpha):
         """
         Register the user by generating the registration key.
         """
-        return pow(self.g, alpha, self.q)
+        return int(self.g_table.pow(alpha))
     
-    def encrypt(self, pks, alpha, data):
+    def encryption_randomness(self, count):
+        """
+        Draw `count` fresh encryption randomness values g^r_i (with odd r_i).
+        Only g^r_i is used by the encryption, so r_i itself is not kept.
+        """
+        g_rs = []
+        for r in random_elements_in_zmod(self.q, count):
+            # Ensure r is odd
+            if r % 2 == 0:
+                r += 1
+            g_rs.append(self.g_table.pow(r))
+        return g_rs
+
+    def encrypt(self, pks, alpha, data, store_c0_inv=False, reg_key=None, pk_tables=None, randomness=None):
         """
         Encrypt the data using the public key vector `pks` and the user-specific `alpha`.
+        With `store_c0_inv` every element is stored as [c0, c1, c0^-1] so that decryption
+        does not need a modular inverse per position. `reg_key` (g^alpha) is computed if not given.
+        `pk_tables` are optional fixed-base tables of the public keys (see Curator.build_pk_tables).
+        `randomness` is an optional list of n precomputed g^r_i values (see encryption_randomness),
+        otherwise it is drawn here. Returns a CiphertextVector.
         """
         #if len(data) != self.n:
         #    raise ValueError("The input data size doesn't match the expected vector size!")
         
+        q = self._q
+        powmod = self.backend.powmod
+        # g^alpha is the registration key, computed once for the whole vector
+        if reg_key is None:
+            reg_key = self.register(alpha)
+        reg_key = self.backend.mpz(reg_key)
+
+        if randomness is None:
+            randomness = self.encryption_randomness(self.n)
+
         ciphertext = []
         for i in range(self.n):
-            r = random_element_in_zmod(self.q)
-         
-            # Ensure r is odd
-            if r % 2 == 0:
-                r += 1
-            # c0 = g^(r_i+alpha), the helping information
-            c0 = pow(self.g, r + alpha, self.q)
-            m = data[i]
-            # cI1 = (pk^alpha)*((g^r_i)^m_i)
-            c1 = (pow(pks[i], alpha, self.q) * pow(pow(self.g, r, self.q), m, self.q)) % self.q
+            g_r = randomness[i]
+            # c0 = g^(r_i+alpha) = g^r_i * g^alpha, the helping information
+            c0 = (g_r * reg_key) % q
+            # cI1 = (pk^alpha)*((g^r_i)^m_i), m_i is small so the second power is cheap
+            pk_alpha = pk_tables[i].pow(alpha) if pk_tables else powmod(pks[i], alpha, q)
+            c1 = (pk_alpha * powmod(g_r, data[i], q)) % q
             ciphertext.append([c0, c1])
+
+        if store_c0_inv:
+            # One inverse for the whole vector instead of one per element
+            c0_invs = batch_mod_inverse([ct[0] for ct in ciphertext], q)
+            for ct, c0_inv in zip(ciphertext, c0_invs):
+                ct.append(c0_inv)
         
-        return ciphertext
+        return CiphertextVector.from_elements([self.backend.to_ints(ct) for ct in ciphertext], limb_size=self.limb_size)
     
-    def key_derivation(self, id, value, sks, reg_key):
+    def key_derivation_base(self, sks, reg_key):
+        """
+        Precompute the per-user vector reg_key^(-sk_i) used by `key_derivation`.
+        It only depends on the user's registration key, so it is computed once at registration.
+        """
+        powmod = self.backend.powmod
+        return self.backend.to_ints([powmod(reg_key, -sk, self._q) for sk in sks[:self.n]])
+
+    def key_derivation(self, id, value, sks, reg_key, kd_base=None):
         """
         Derive the decryption keys for a specific query value `v` and user `id`.
+        If the precomputed `kd_base` of the user is given, dk_i = reg_key^v * reg_key^(-sk_i)
+        costs one exponentiation in total instead of one per position.
         """
+        q = self._q
+        if kd_base is not None:
+            reg_key_v = self.backend.powmod(reg_key, value, q)
+            return self.backend.to_ints([(reg_key_v * base) % q for base in kd_base[:self.n]])
+
         dk = []
         for i in range(self.n):
             vs = value - sks[i]
-            dk.append(pow(reg_key, vs, self.q))
-        return dk
+            dk.append(self.backend.powmod(reg_key, vs, q))
+        return self.backend.to_ints(dk)
     
     def decrypt(self, dk, value, ciphertexts):
         """
         Decrypt the ciphertexts using the decryption keys `dk` and query value `v`.
         """
+        q = self._q
+        powmod = self.backend.powmod
         results = []
         for i in range(self.n):
             ci = ciphertexts[i]
         
-            # vb is the negation of the value (in Python, we handle big integers with the int type)
-            vb = -value
-        
-            # Calculate ci[0] ^ (-value) % q
-            # This is equivalent to finding the modular inverse of ci[0] ** value mod q
-            c0_inv = pow(ci[0], vb, self.q)
+            if len(ci) > 2 and value >= 0:
+                # The inverse of c0 is stored, so c0^(-value) is only a small power of it
+                # (query values are at most 16, which is a handful of multiplications)
+                c0_inv = powmod(ci[2], value, q)
+            else:
+                # vb is the negation of the value (in Python, we handle big integers with the int type)
+                vb = -value
+
+                # Calculate ci[0] ^ (-value) % q
+                # This is equivalent to finding the modular inverse of ci[0] ** value mod q
+                c0_inv = powmod(ci[0], vb, q)
         
             # Now, yi = dk[i] * (ci[1] * c0_inv) % q
-            yi = (dk[i] * (ci[1] * c0_inv) % self.q) % self.q
+            yi = (dk[i] * (ci[1] * c0_inv) % q) % q
         
             # Append the decrypted value to the results
             results.append(yi)
     
+        return self.backend.to_ints(results)
+
+    def decrypt_batch(self, dk, value, ciphertexts):
+        """
+        Same as `decrypt`, but inverts all c0 values of the vector together with one
+        modular inverse (batch inversion) when the ciphertext has no stored c0 inverses.
+        """
+        return self.decrypt_columns(dk, value, self.decode(ciphertexts))
+
+    def decode(self, ciphertexts):
+        """
+        Decode the first n elements of a CiphertextVector (or a list of elements) into
+        value columns of ints: [c0s, c1s] or [c0s, c1s, c0_invs].
+        """
+        cts = ciphertexts[:self.n]
+        if isinstance(cts, CiphertextVector):
+            width = cts.width
+        else:
+            width = len(cts[0]) if cts else 2
+        return ciphertext_columns(cts, width)
+
+    def decrypt_values(self, values, sks, reg_key, ciphertexts, kd_base=None):
+        """
+        Decrypt the ciphertext for several non-negative query values at once, returns
+        {value: matches} where matches are booleans of the positions that decrypt to 1.
+        With dk_i = reg_key^v * kd_base_i the decryption is y_i = (kd_base_i * c1_i) * (reg_key * c0_i^-1)^v,
+        so the ciphertext is decoded once and the next value costs one multiplication per position.
+        """
+        values = sorted(set(values))
+        if values and values[0] < 0:
+            raise ValueError("Query values must be non-negative!")
+        q = self._q
+        mpz = self.backend.mpz
+        powmod = self.backend.powmod
+        if kd_base is None:
+            kd_base = self.key_derivation_base(sks, reg_key)
+        reg_key = mpz(reg_key)
+
+        columns = self.decode(ciphertexts)
+        c0_invs = columns[2] if len(columns) > 2 else batch_mod_inverse([mpz(c0) for c0 in columns[0]], q)
+        steps = [(reg_key * c0_inv) % q for c0_inv in c0_invs]
+        # The decryption for value 0
+        acc = [(mpz(base) * c1) % q for base, c1 in zip(kd_base, columns[1])]
+
+        results = {}
+        current = 0
+        for value in values:
+            gap = value - current
+            if gap > 8:
+                acc = [(y * powmod(step, gap, q)) % q for y, step in zip(acc, steps)]
+            else:
+                for _ in range(gap):
+                    acc = [(y * step) % q for y, step in zip(acc, steps)]
+            current = value
+            results[value] = [y == 1 for y in acc]
         return results
+
+    def decrypt_columns(self, dk, value, columns, matches=False):
+        """
+        `decrypt_batch` on already decoded value columns (see `decode`). With `matches` only
+        whether each element decrypted to 1 is returned (as booleans), which skips converting
+        the results to Python ints.
+        """
+        c1s = columns[1]
+
+        q = self._q
+        if value < 0:
+            # c0^(-value) is then a plain power, no inverses needed
+            c0_invs = columns[0]
+            value = -value
+        elif len(columns) > 2:
+            c0_invs = columns[2]
+        else:
+            c0_invs = batch_mod_inverse([self.backend.mpz(c0) for c0 in columns[0]], q)
+
+        powmod = self.backend.powmod
+        decrypted = [(d * c1 * powmod(c0_inv, value, q)) % q for d, c1, c0_inv in zip(dk, c1s, c0_invs)]
+        if matches:
+            return [y == 1 for y in decrypted]
+        return self.backend.to_ints(decrypted)
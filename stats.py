@@ -0,0 +1,77 @@
+# stats.py
+# Statistics of a decrypted query result, where the positions that match the query value are 1.
+# Used by the Analyst on full results and by the server for aggregation pushdown.
+
+AGGREGATIONS = ("count", "transitions", "sequences")
+
+def count_the_value(decrypted_data):
+    """
+    Count the amount of the value (1 since the query values is 1 in the decryption) in the data
+    """
+    return decrypted_data.count(1)
+
+def count_transitions(decrypted_data):
+    """
+    Count how many times the value (1 since the query values is 1 in the decryption) jumps to other values in the hypnogram's values.
+    """
+    return value_stats(decrypted_data)["transitions"]
+
+def count_sequences(decrypted_data):
+    """
+    Count how many distinct sequences of the value (1 since the query values is 1 in the decryption) appear in the hypnogram's values.
+    """
+    return value_stats(decrypted_data)["sequences"]
+
+def value_stats(decrypted_data):
+    """The count, transitions and sequences of the value in one pass over the data."""
+    count = 0
+    transitions = 0
+    sequences = 0
+    previous = False
+    for value in decrypted_data:
+        match = value == 1
+        if match:
+            count += 1
+            if not previous:  # Start of a new sequence
+                sequences += 1
+        elif previous:  # The value jumps to another value
+            transitions += 1
+        previous = match
+    return {"count": count, "transitions": transitions, "sequences": sequences}
+
+def check_aggregation(aggregation):
+    """Raise ValueError if `aggregation` is not one of AGGREGATIONS or "all"."""
+    if aggregation != "all" and aggregation not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation: {aggregation} (use one of {', '.join(AGGREGATIONS)} or all)")
+
+def aggregate(decrypted_data, aggregation="all"):
+    """The statistic named by `aggregation` (see AGGREGATIONS), or all of them with "all", as a dict."""
+    check_aggregation(aggregation)
+    stats = value_stats(decrypted_data)
+    if aggregation == "all":
+        return stats
+    return {aggregation: stats[aggregation]}
+
+def histogram_and_transitions(matches_by_value):
+    """
+    The histogram ({value: count}) and the transition matrix of a multi-value query result
+    ({value: matches}, see SPADE.decrypt_values). matrix[a][b] counts the adjacent positions
+    where the value at index a of the sorted values is followed by the value at index b.
+    Positions that matched none of the values are left out.
+    """
+    values = sorted(matches_by_value)
+    length = len(matches_by_value[values[0]]) if values else 0
+    labels = [None] * length
+    histogram = {}
+    for index, value in enumerate(values):
+        matches = matches_by_value[value]
+        histogram[value] = matches.count(True)
+        for i, match in enumerate(matches):
+            if match:
+                labels[i] = index
+
+    matrix = [[0] * len(values) for _ in values]
+    for a, b in zip(labels, labels[1:]):
+        if a is not None and b is not None:
+            matrix[a][b] += 1
+    return {"values": values, "histogram": histogram, "transition_matrix": matrix}
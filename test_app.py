@@ -1,14 +1,16 @@
 import atexit
-from models.handlers import DBHandler, PBHandler
-from models.user import User, create_user
+from models.handlers import DBHandler, close_pooled_connections
+from models.user import create_user, create_users
 from models.curator import Curator
-from spade import SPADE
-from config import DbName, TbName, NumUsers, PaddingItem, MODULUS, GENERATOR, MAX_PT_VEC_SIZE
-from utils import read_dna_seq_file, convert_dna_seq_to_dinucleotide, map_dinucleotide_to_int, add_padding
+from models.query import query_user, query_user_values, query_users, aggregate_users
+import functools
+import stats
+import result_codec
+from config import DbName, TbName, NumUsers, MAX_PT_VEC_SIZE, HYPNO_VALUES
+from utils import map_dinucleotide_to_int
 import json
 import os
 import time
-import tracemalloc
 import random
 import utils
 
@@ -74,48 +76,40 @@ def register_dna(user_id, dna_data):
     except Exception as e:
         return json.dumps({"status": "error", "message": str(e)}), 500
 
-
-def analyst_query(user_id, query_value):
+def analyst_query(user_id, query_value, aggregation=None, encoding=None):
     start_time = time.time()
     try:
+        if aggregation:
+            stats.check_aggregation(aggregation)
+        if encoding:
+            result_codec.check_encoding(encoding)
 
         db_handler2 = DBHandler(DbName, TbName)
 
         # Retrieve user data from the database
-        user_req = db_handler2.get_user_req_by_id(user_id)
+        start_time = time.time()
+        user_req = db_handler2.get_user_req_by_id(user_id, as_vector=True)
+        time_of_read = time.time() - start_time
         if not user_req:
             return json.dumps({"status": "error", "message": "User data not found!"}), 404
 
         db_handler2.close_connection()
 
-        # Start the analyst operation (decrypt the user's data)
-        spade = SPADE(MODULUS, GENERATOR, MAX_PT_VEC_SIZE)
-        
-
-        # Derive decryption keys using the provided query value and the registration key
-        reg_key = int.from_bytes(user_req['reg_key'], byteorder='big')
-        tracemalloc.start()
-        start_time = time.time()
-        dk = spade.key_derivation(user_id, query_value, curator.sks, reg_key)
-        time_of_kd = time.time() - start_time
-        current_kd, peak_memory_kd = tracemalloc.get_traced_memory()
-        tracemalloc.stop()
-
-        # Decrypt the ciphertext using the derived keys
-        ciphertext = user_req['ciphertext']
-        # Reconstruct ciphertext from stored bytes
-        reconstructed_ciphertext = []
-        for c0_bytes, c1_bytes in ciphertext:  # Assume storage preserves tuple structure
-            c0 = int.from_bytes(c0_bytes, byteorder='big')
-            c1 = int.from_bytes(c1_bytes, byteorder='big')
-            reconstructed_ciphertext.append([c0, c1])  # Restore as [c0, c1] pairs
-
-        tracemalloc.start()
+        # Derive the decryption keys and decrypt the user's data, in a worker process when
+        # the server runs with a worker pool (see serve.py)
+        # The statistics and the compact encodings only need to know which positions match
+        matches = bool(aggregation) or encoding not in (None, "list")
         start_time = time.time()
-        decrypted = spade.decrypt(dk, query_value, reconstructed_ciphertext)
-        time_of_decrypt = time.time() - start_time
-        current_dec, peak_memory_dec = tracemalloc.get_traced_memory()
-        tracemalloc.stop()
+        decrypted, measures = query_user(curator, user_req, query_value, matches)
+
+        # With an aggregation only the statistics are sent back, computed in one pass over the result
+        if aggregation:
+            result = {"aggregates": stats.aggregate(decrypted, aggregation)}
+        elif encoding:
+            # Compact encoding of the matching positions, see result_codec
+            result = {"encoded_result": result_codec.encode_result(decrypted, encoding)}
+        else:
+            result = {"decrypted_result": decrypted}
 
         # Time taken
         elapsed_time = time.time() - start_time
@@ -125,21 +119,21 @@ def analyst_query(user_id, query_value):
         return json.dumps({
             "status": "success",
             "query_value": query_value,
-            "decrypted_result": decrypted,  # Return the decrypted result
-            "time_of_kd": time_of_kd,
-            "time_of_dec": time_of_decrypt,
-            "current_kd": current_kd,
-            "peak_memory_kd": peak_memory_kd,
-            "current_dec": current_dec,
-            "peak_memory_dec": peak_memory_dec
+            **result,  # The decrypted result, or only its statistics with an aggregation
+            "time_of_read": time_of_read,
+            **measures  # The time and the memory of the key derivation, the decoding and the decryption
         }), 200
 
     except Exception as e:
         return json.dumps({"status": "error", "message": str(e)}), 500
     
-def analyst_query_dna(user_id, query_value_str):
+def analyst_query_dna(user_id, query_value_str, aggregation=None, encoding=None):
     start_time = time.time()
     try:
+        if aggregation:
+            stats.check_aggregation(aggregation)
+        if encoding:
+            result_codec.check_encoding(encoding)
 
         # Map dinucleotide to integer (e.g., "CC" -> 6)
         query_value = map_dinucleotide_to_int([query_value_str])[0]
@@ -147,39 +141,29 @@ def analyst_query_dna(user_id, query_value_str):
         db_handler2 = DBHandler(DbName, TbName)
 
         # Retrieve user data from the database
-        user_req = db_handler2.get_user_req_by_id(user_id)
+        start_time = time.time()
+        user_req = db_handler2.get_user_req_by_id(user_id, as_vector=True)
+        time_of_read = time.time() - start_time
         if not user_req:
             return json.dumps({"status": "error", "message": "User data not found!"}), 404
 
         db_handler2.close_connection()
 
-        # Start the analyst operation (decrypt the user's data)
-        spade = SPADE(MODULUS, GENERATOR, MAX_PT_VEC_SIZE)
-        
-        tracemalloc.start()
-        start_time = time.time()
-        # Derive decryption keys using the provided query value and the registration key
-        reg_key = int.from_bytes(user_req['reg_key'], byteorder='big')
-        dk = spade.key_derivation(user_id, query_value, curator.sks, reg_key)
-        time_of_kd = time.time() - start_time
-        current_kd, peak_memory_kd = tracemalloc.get_traced_memory()
-        tracemalloc.stop()
-
-        # Decrypt the ciphertext using the derived keys
-        ciphertext = user_req['ciphertext']
-        # Reconstruct ciphertext from stored bytes
-        reconstructed_ciphertext = []
-        for c0_bytes, c1_bytes in ciphertext:  # Assume storage preserves tuple structure
-            c0 = int.from_bytes(c0_bytes, byteorder='big')
-            c1 = int.from_bytes(c1_bytes, byteorder='big')
-            reconstructed_ciphertext.append([c0, c1])  # Restore as [c0, c1] pairs
-
-        tracemalloc.start()
+        # Derive the decryption keys and decrypt the user's data, in a worker process when
+        # the server runs with a worker pool (see serve.py)
+        # The statistics and the compact encodings only need to know which positions match
+        matches = bool(aggregation) or encoding not in (None, "list")
         start_time = time.time()
-        decrypted = spade.decrypt(dk, query_value, reconstructed_ciphertext)
-        time_of_decrypt = time.time() - start_time
-        current_dec, peak_memory_dec = tracemalloc.get_traced_memory()
-        tracemalloc.stop()
+        decrypted, measures = query_user(curator, user_req, query_value, matches)
+
+        # With an aggregation only the statistics are sent back, computed in one pass over the result
+        if aggregation:
+            result = {"aggregates": stats.aggregate(decrypted, aggregation)}
+        elif encoding:
+            # Compact encoding of the matching positions, see result_codec
+            result = {"encoded_result": result_codec.encode_result(decrypted, encoding)}
+        else:
+            result = {"decrypted_result": decrypted}
 
         # Time taken
         elapsed_time = time.time() - start_time
@@ -189,13 +173,9 @@ def analyst_query_dna(user_id, query_value_str):
         return json.dumps({
             "status": "success",
             "query_value": query_value,
-            "decrypted_result": decrypted,
-            "time_of_kd": time_of_kd,
-            "time_of_dec": time_of_decrypt,
-            "current_kd": current_kd,
-            "peak_memory_kd": peak_memory_kd,
-            "current_dec": current_dec,
-            "peak_memory_dec": peak_memory_dec
+            **result,  # The decrypted result, or only its statistics with an aggregation
+            "time_of_read": time_of_read,
+            **measures  # The time and the memory of the key derivation, the decoding and the decryption
         }), 200
 
     except Exception as e:
@@ -248,6 +228,86 @@ def test_query_hypno(user_id, query_value, vector_size):
         print(f"Failed request for User {user_id} | Query: {query_value} | Status Code: {response[1]} | Error: {responseJson.get('message')}")
         return elapsed_time
 
+def test_bulk_registration(datasets, first_id, query_value, vector_size):
+    """
+    Register the datasets again with create_users (the bulk registration) from user id `first_id` and
+    check that their query results equal the ones of the users registered one by one (ids from 0).
+    """
+    start_time = time.time()
+    statuses, time_of_enc, time_of_insert = create_users([(first_id + i, dataset) for i, dataset in enumerate(datasets)], vector_size, curator)
+    elapsed_time = time.time() - start_time
+
+    failed = [status for status in statuses if status['status'] != "success"]
+    for i in range(len(datasets)):
+        single = json.loads(analyst_query(i, query_value, encoding="bitmap")[0])
+        bulk = json.loads(analyst_query(first_id + i, query_value, encoding="bitmap")[0])
+        if bulk.get('encoded_result') is None or bulk.get('encoded_result') != single.get('encoded_result'):
+            failed.append({"user_id": first_id + i, "message": "query result differs from the single registration"})
+
+    print(f"Bulk registration | Users: {len(datasets)} | Time Taken: {elapsed_time:.4f}s | Time of enc: {time_of_enc:.10f}s | Time of insert: {time_of_insert:.10f}s | {'OK' if not failed else f'FAILED: {failed}'}")
+    return not failed
+
+def test_query_many(user_ids, query_value):
+    """
+    Query the users with query_users (one streamed SELECT, the multi-user query) and check every
+    result against the single user query.
+    """
+    start_time = time.time()
+    db_handler2 = DBHandler(DbName, TbName)
+    mapper = functools.partial(result_codec.encode_result, encoding="bitmap")
+    results = list(query_users(curator, db_handler2.iter_user_reqs(user_ids), query_value, mapper=mapper, matches=True))
+    db_handler2.close_connection()
+    elapsed_time = time.time() - start_time
+
+    failed = [user_id for user_id in user_ids if user_id not in {result[0] for result in results}]
+    for user_id, result, error in results:
+        single = json.loads(analyst_query(user_id, query_value, encoding="bitmap")[0])
+        if error is not None or json.loads(json.dumps(result)) != single.get('encoded_result'):
+            failed.append(user_id)
+
+    print(f"Multi-user query | Users: {len(user_ids)} | Query: {query_value} | Time Taken: {elapsed_time:.4f}s | {'OK' if not failed else f'FAILED users: {failed}'}")
+    return not failed
+
+def test_aggregate(user_ids, query_value):
+    """
+    Aggregate the users with aggregate_users (map-reduce over the query workers) and check the total
+    count and the per-user histogram against the counts of the single user queries.
+    """
+    start_time = time.time()
+    db_handler2 = DBHandler(DbName, TbName)
+    aggregates = aggregate_users(curator, db_handler2.iter_user_reqs(user_ids), query_value)
+    db_handler2.close_connection()
+    elapsed_time = time.time() - start_time
+
+    counts = [json.loads(analyst_query(user_id, query_value, aggregation="count")[0])['aggregates']['count'] for user_id in user_ids]
+    histogram = {}
+    for count in counts:
+        histogram[str(count)] = histogram.get(str(count), 0) + 1
+    aggregated = json.loads(json.dumps(aggregates))
+    ok = aggregates['users'] == len(user_ids) and aggregates['total_count'] == sum(counts) and aggregated['histogram'] == histogram
+
+    print(f"Aggregate | Users: {aggregates['users']} | Query: {query_value} | Total count: {aggregates['total_count']} | Time Taken: {elapsed_time:.4f}s | {'OK' if ok else f'FAILED: {aggregates} vs counts {counts}'}")
+    return ok
+
+def test_query_values(user_id, values):
+    """
+    Query all `values` of the user at once with query_user_values (the multi-value query) and check the
+    histogram against one single user count query per value.
+    """
+    start_time = time.time()
+    db_handler2 = DBHandler(DbName, TbName)
+    user_req = db_handler2.get_user_req_by_id(user_id, as_vector=True)
+    db_handler2.close_connection()
+    result = stats.histogram_and_transitions(query_user_values(curator, user_req, values))
+    elapsed_time = time.time() - start_time
+
+    counts = {str(value): json.loads(analyst_query(user_id, value, aggregation="count")[0])['aggregates']['count'] for value in values}
+    histogram = json.loads(json.dumps(result['histogram']))
+    ok = histogram == counts
+
+    print(f"Multi-value query | User: {user_id} | Values: {len(values)} | Time Taken: {elapsed_time:.4f}s | {'OK' if ok else f'FAILED: {histogram} vs counts {counts}'}")
+    return ok
+
 # Function to generate and test multiple users with different vector sizes
 def run_performance_tests():
     user_count = NumUsers
@@ -255,6 +315,8 @@ def run_performance_tests():
     
     # Process all hypnogram files in the directory
     hypnogram_data = utils.process_hypnogram_files(HYPNO_DIR)
+    # There may be less files than users
+    user_count = min(user_count, len(hypnogram_data))
     
     query_value = generate_random_hypno_sequence()
 
@@ -307,17 +369,33 @@ def run_performance_tests():
     print(f"Total memory allecations for key derivation: {total_memory_kd / 1024:.2f} KB")
     print(f"Total memory allecations for decryption: {total_memory_dec / 1024:.2f} KB\n")
 
+    # The bulk and multi-user paths must give the same results as the single user ones
+    print("Running the bulk and multi-user checks against the single user queries...")
+    # The most common value of the first user, so that the checks have matches to compare
+    check_value = max(set(hypnogram_data[0]), key=hypnogram_data[0].count)
+    test_bulk_registration(hypnogram_data[:user_count], user_count, check_value, vector_size)
+    test_query_many(list(range(2 * user_count)), check_value)
+    test_aggregate(list(range(2 * user_count)), check_value)
+    test_query_values(0, HYPNO_VALUES)
+
 def cleanup():
     """Close the database connection and remove the database file when the program exits."""
     try:
+        # Remove the shared memory of the keys used by the worker processes
+        curator.close_shared_keys()
+
         # Ensure the database connection is closed
         db_handler.close_connection()  # Ensure DBHandler has a close_connection() method
+        close_pooled_connections()
         print("Database connection closed.")
 
-        # Remove the database file
+        # Remove the database file (and the WAL files next to it)
         if os.path.exists(DbName):
             os.remove(DbName)
             print(f"Database {DbName} has been removed.")
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(DbName + suffix):
+                os.remove(DbName + suffix)
     except Exception as e:
         print(f"Error during cleanup: {e}")
 
@@ -0,0 +1,66 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+# Import-time budget of the runtime modules, measured with python -X importtime:
+#   python test_import_time.py
+
+# Cumulative import time budget per module in ms (a few times the measured time, so that a slow
+# machine doesn't fail it but a new eager heavy import does)
+BUDGETS_MS = {
+    "spade": 15,
+    "models.handlers": 15,
+    "models.query": 15,
+    "models.user": 25,
+    "models.curator": 25,
+    "models.analyst": 10,
+    "app": 40,
+}
+
+# Imports that aren't counted in the budget of a module: the cost of the web framework (flask is
+# about 50 ms by itself) is subtracted from app, the budget covers the app's own modules and setup
+EXCLUDED_IMPORTS = {
+    "app": ("flask",),
+}
+
+# Modules that must only be imported when they are used
+LAZY_MODULES = ("requests", "Crypto", "sympy", "multiprocessing", "tracemalloc", "numpy", "gmpy2")
+
+def import_times(module):
+    """Return the imported modules of a fresh `import module` with their cumulative import times in us."""
+    # Run in an empty directory, importing app creates the database file in the working directory
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as cwd:
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                capture_output=True, text=True, check=True, cwd=cwd, env=env)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+def check_module(module, repeat=3):
+    """Return the best import time of `module` in ms and the lazy modules it imported."""
+    best = None
+    for _ in range(repeat):
+        times = import_times(module)
+        elapsed = (times[module] - sum(times.get(name, 0) for name in EXCLUDED_IMPORTS.get(module, ()))) / 1000
+        best = elapsed if best is None else min(best, elapsed)
+    eager = sorted(name for name in times if name.split(".")[0] in LAZY_MODULES)
+    return best, eager
+
+if __name__ == "__main__":
+    failures = 0
+    for module, budget_ms in BUDGETS_MS.items():
+        elapsed, eager = check_module(module)
+        ok = elapsed <= budget_ms and not eager
+        failures += not ok
+        print(f"{'OK  ' if ok else 'FAIL'} {module:<16} {elapsed:6.2f} ms (budget {budget_ms} ms)"
+              + (f" | imports {', '.join(eager)}" if eager else ""))
+    if failures:
+        print(f"{failures} module(s) over the import-time budget")
+        sys.exit(1)
+    print("All modules within the import-time budget")
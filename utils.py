@@ -1,11 +1,7 @@
 import os
 import random
-import json
-from pathlib import Path
-from math import log2, gcd  # Added gcd import from math
-from typing import List, Tuple
-from math import ceil
-import struct
+import secrets
+from typing import List
 import config
 
 PORT = 50505
@@ -73,6 +69,7 @@ def process_dna_files(directory):
 
 # Normalize hypnogram datasets
 def normalize_hypnogram_datasets(dir_path: str, norm_val: int):
+    from pathlib import Path
     files = list(Path(dir_path).glob("*.txt"))
     print(f"Number of files: {len(files)}")
 
@@ -169,6 +166,44 @@ def map_dinucleotide_to_int(dinucleotides: List[str]) -> List[int]:
     }
     return [dinu_map.get(dinu, 0) for dinu in dinucleotides]
 
+def batch_mod_inverse(values: List[int], modulus: int) -> List[int]:
+    """
+    Invert all values mod `modulus` at once (Montgomery's trick): one modular inverse
+    and about 3n multiplications instead of n inverses. All values must be invertible.
+    """
+    # prefix[i] = values[0] * ... * values[i-1]
+    prefix = [1] * (len(values) + 1)
+    acc = 1
+    for i, v in enumerate(values):
+        acc = (acc * v) % modulus
+        prefix[i + 1] = acc
+
+    inv = pow(acc, -1, modulus)
+    inverses = [0] * len(values)
+    for i in range(len(values) - 1, -1, -1):
+        inverses[i] = (inv * prefix[i]) % modulus
+        inv = (inv * values[i]) % modulus
+    return inverses
+
 def random_element_in_zmod(modulus):
-    # Example implementation of random element in Zmod
-    return random.randint(1, modulus - 1)
+    # Uniform element of [1, modulus - 1] from the OS CSPRNG
+    return secrets.randbelow(modulus - 1) + 1
+
+def random_elements_in_zmod(modulus: int, count: int) -> List[int]:
+    """
+    Return `count` uniform elements of [1, modulus - 1] from the OS CSPRNG.
+    The random bytes are read in one block and cut into 64 bits wider numbers than the
+    modulus; numbers above the largest multiple of (modulus - 1) are rejected so that the
+    reduction is exactly uniform (which almost never happens with the 64 extra bits).
+    """
+    span = modulus - 1
+    width = (span.bit_length() + 64 + 7) // 8
+    limit = (1 << (8 * width)) // span * span
+    from_bytes = int.from_bytes
+
+    elements = []
+    while len(elements) < count:
+        block = os.urandom((count - len(elements)) * width)
+        chunks = (block[i:i + width] for i in range(0, len(block), width))
+        elements += [x % span + 1 for x in map(from_bytes, chunks) if x < limit]
+    return elements